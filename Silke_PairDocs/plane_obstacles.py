@@ -52,12 +52,10 @@ class Plane:
             self.data[k, 11] = 0.0
 
     def writeInifile(self, filename):
-        out = open(filename, 'w')
-        out.write('# Total of %s particles\n' % str(self.N))
-        out.write('# id  type radius  x   y   z   vx   vy   vz   nx   ny   nz\n')
-        for k in range(self.N):
-            out.write('%d  %d  %f %f  %f  %f  %f  %f  %f  %f  %f  %f\n' % tuple(self.data[k, :]))
-        out.close()
+        header = '# Total of %s particles\n' % str(self.N)
+        header += '# id  type radius  x   y   z   vx   vy   vz   nx   ny   nz'
+        np.savetxt(filename, self.data, fmt='%d  %d  %f %f  %f  %f  %f  %f  %f  %f  %f  %f', header=header,
+                   comments='')
 
 
 parser = argparse.ArgumentParser()
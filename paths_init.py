@@ -8,6 +8,8 @@ system_paths = {
     "samos_dir": "/home/andreadis/Documents/SAMoS-ABPactreact/build/samos",
     # Path where simulation results should be saved ".../samos_output"
     "output_samos_dir": "/data1/andreadis/samos_output",
+    # Path where generated initial configurations are cached for reuse ".../init_cache" (see samos_handler.py)
+    "init_cache_dir": "/data1/andreadis/samos_init_cache",
     # Path of configuration file(s) ".../*.conf"
     "conf_file": "/data1/andreadis/CellSim/samos_init/spheroid.conf",
     "conf_file_trackers": "/data1/andreadis/CellSim/samos_init/spheroid_trackers.conf",
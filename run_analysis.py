@@ -37,6 +37,7 @@ def run_analysis():
     parser.add_argument("-visualise", action="store_true", help="Visualise results?")
     parser.add_argument("-show", action="store_true", help="Show results?")
     parser.add_argument("-debug", action="store_true", help="Debug?")
+    parser.add_argument("-msd_log", action="store_true", help="MSD at log-spaced lag times only?")
 
     parser.add_argument("-dat_iter_debug", type=int, default=None, help="Number of cores to run on in parallel?")
     parser.add_argument("-idx_iter_debug", type=int, default=None, help="Number of cores to run on in parallel?")
@@ -5,6 +5,7 @@ Author: Konstantinos Andreadis
 import argparse
 from scripts.communication_handler import print_log
 from scripts.samos_handler import run_sweep
+from scripts.sweep_planner import make_axis, parse_axis, sampling_types
 
 if __name__ == "__main__":
     print_log("=== Start ===")
@@ -48,10 +49,35 @@ if __name__ == "__main__":
     parser.add_argument("-re", type=float, default=1.15, help="Soft sphere attraction strength?")
     parser.add_argument("-ri", type=float, default=1.5, help="Pair activity potential factor?")
 
+    # Initial packing: "random" positions overlap heavily and need a long relaxation run, "rsa" (random sequential
+    # addition) bounds the overlap so that Nrelax can be reduced.
+    parser.add_argument("-packing", type=str, default="random", choices=["random", "rsa"], help="Initial packing?")
+    parser.add_argument("-overlap", type=float, default=0.1, help="Maximum relative overlap of rsa packing?")
+    parser.add_argument("-Nrelax", type=int, default=10000, help="Number of relaxation time steps?")
+    # !! Without a seed every run draws its own initial configuration (as before), which is then neither cached nor
+    # relaxed once and shared: pass e.g. -seed 1 to enable the init cache and the shared relaxation.
+    parser.add_argument("-seed", type=int, default=None, help="Seed of the initial configuration (None: unseeded)?")
+    parser.add_argument("-relaxation", type=str, default="shared", choices=["shared", "per_run"],
+                        help="Relax once per initial configuration and share it, or relax within every run?")
+
     # Enable SAMoS execution. This is useful to first look at the result folder structure during debugging
     parser.add_argument("-disable_samos", action="store_true", help="Disable SAMoS executable?")
     parser.add_argument("-digit_precision", type=int, default=5, help="Digits of precision for value ranges?")
-
+    parser.add_argument("-archive_init", type=str, default="none", choices=["none", "gzip", "npy"],
+                        help="Archive particles.txt of finished simulations compressed (gzip) or packed (npy)?")
+
+    # Parameters to vary, any number of "-vary name:type:start:end:num" (type linear/log) or "-vary name:custom:a,b,c".
+    # No parameters to vary -> only global variables are used for a single run.
+    parser.add_argument("-vary", type=str, action="append", default=[],
+                        help="Variable parameter name:type:start:end:num?")
+    parser.add_argument("-sampling", type=str, default="grid", choices=sampling_types,
+                        help="Combination of variable parameters (grid/zip/random/lhs)?")
+    parser.add_argument("-Nsamples", type=int, default=10, help="Number of parameter points for random/lhs sampling?")
+    parser.add_argument("-sampling_seed", type=int, default=0, help="Seed of random/lhs sampling?")
+    parser.add_argument("-schedule", type=str, default="longest", choices=["longest", "order"],
+                        help="Start the longest simulations first, or in sweep order?")
+
+    # Older interface for up to 3 variable parameters, added before the -vary parameters.
     # First/only parameter to vary. v1 = None -> only global variables are used for a single run.
     parser.add_argument("-v1", type=str, default=None, help="Name of variable parameter 1?")
     parser.add_argument("-v1type", type=str, default="linear", help="Range type of variable parameter 1?")
@@ -84,50 +110,36 @@ if __name__ == "__main__":
     parser.add_argument("-phi", type=float, default=1.0, help="Packing fraction phi?")
 
     parser.add_argument("-Ncores", type=int, default=8, help="Number of cores to run on in parallel?")
+    parser.add_argument("-timeout", type=float, default=None, help="Kill a simulation after this many seconds?")
 
     args = parser.parse_args()
 
-    if args.v1custom:
-        args.v1type = "custom"
-    if args.v2custom:
-        args.v2type = "custom"
-    if args.v3custom:
-        args.v3type = "custom"
     args.tumoroid_ecm = True
     if args.track:
         args.session += "_tracked"
 
     # User input processing logic
+    sweep_axes = []
+    for v in ["v1", "v2", "v3"]:
+        if args.__dict__[v] is not None:
+            sweep_axes.append(make_axis(name=args.__dict__[v], range_type=args.__dict__[f"{v}type"],
+                                        start=args.__dict__[f"{v}start"], end=args.__dict__[f"{v}end"],
+                                        num=args.__dict__[f"{v}num"], values=args.__dict__[f"{v}custom"]))
+    for vary in args.vary:
+        sweep_axes.append(parse_axis(vary))
+
     global_parameters = {}
-    parameter_1D_sweep = {}
-    parameter_2D_sweep = {}
-    parameter_3D_sweep = {}
-    sweep_type = None
-
-    if args.v1 is None and args.v2 is None and args.v3 is None:
-        sweep_type = 0
-    elif args.v1 is not None and args.v2 is None and args.v3 is None:
-        sweep_type = 1
-    elif args.v1 is not None and args.v2 is not None and args.v3 is None:
-        sweep_type = 2
-    elif args.v1 is not None and args.v2 is not None and args.v3 is not None:
-        sweep_type = 3
     for var in args.__dict__.keys():
-        if var[:2] not in ["v1", "v2", "v3"]:
+        if var[:2] not in ["v1", "v2", "v3"] and var not in ["vary", "sampling", "Nsamples", "sampling_seed",
+                                                             "schedule"]:
             global_parameters[var] = args.__dict__[var]
-        elif sweep_type == 1:
-            parameter_1D_sweep[var] = args.__dict__[var]
-        elif sweep_type == 2:
-            parameter_2D_sweep[var] = args.__dict__[var]
-        elif sweep_type == 3:
-            parameter_3D_sweep[var] = args.__dict__[var]
     enable_samos_exec = not global_parameters["disable_samos"]
     group_folder = global_parameters["session"]
     debug = global_parameters["debug"]
 
     # Execution of main samos handling script(s).
-    run_sweep(sweep_type=sweep_type, global_parameters=global_parameters, parameter_1D_sweep=parameter_1D_sweep,
-              parameter_2D_sweep=parameter_2D_sweep, parameter_3D_sweep=parameter_3D_sweep,
-              enable_samos_exec=enable_samos_exec, group_folder=group_folder,
-              debug=debug, digit_precision=args.digit_precision, num_cores=args.Ncores)
+    run_sweep(sweep_axes=sweep_axes, global_parameters=global_parameters, enable_samos_exec=enable_samos_exec,
+              group_folder=group_folder, debug=debug, digit_precision=args.digit_precision, num_cores=args.Ncores,
+              timeout=args.timeout, sampling=args.sampling, num_samples=args.Nsamples,
+              sampling_seed=args.sampling_seed, schedule=args.schedule)
     print_log("=== End ===")
@@ -4,146 +4,244 @@ Author: Konstantinos Andreadis
 """
 import os
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import argparse
 import cv2
 import textwrap
+from collections import deque
 from multiprocessing import Pool
 from paths_init import system_paths
 from scripts.communication_handler import print_log
+from scripts.data_handler import read_dat
+from scripts.raster_renderer import render_raster, color_modes
+from scripts.trajectory_store import list_dat_files, is_store_valid, map_trajectory_store, read_store_frame, \
+    store_folder_name
 
 
-def read_dat(path):
+def particle_styles(args):
     """
-    Read a .dat file and shift its columns to properly import data as DataFrame.
+    Color and opacity of each particle type: {type: [color, alpha]}. Only cells (type 1) if onlycells.
     """
-    data = pd.read_csv(path, header=0, sep='\s+')
-    colshift = {data.columns[u]: data.columns[u + 1] for u in range(len(data.columns) - 1)}
-    data.rename(columns={data.columns[-1]: 'none'}, inplace=True)
-    data.rename(columns=colshift, inplace=True, errors="raise")
-    return data
+    styles = {1: [args.cell_color, args.cell_alpha]}
+    if not args.onlycells:
+        styles[2] = [args.ECM_color, args.ECM_alpha]
+    return styles
 
 
-def plot_particles(folder_path, movie_dir, args):
+def create_frame_figure(args, title=""):
     """
-    Plot all particles
+    Creates the 3D figure reused for all frames of a movie: box axes, limits, title (space) and one (empty) scatter
+    artist per particle type, see particle_styles. Returns the figure, its axes and the artists {type: scatter}.
+    The figure is drawn on its own Agg canvas (500 x 500 pixels), independent of pyplot, see render_image.
     """
     L = args.L
+    fig = Figure(figsize=(5, 5), dpi=100)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111, projection='3d')
+    x, y, z = np.array([[-L / 2, 0, 0], [0, -L / 2, 0], [0, 0, -L / 2]])
+    u, v, w = np.array([[L, 0, 0], [0, L, 0], [0, 0, L]])
+    ax.quiver(x, y, z, u, v, w, arrow_length_ratio=0.1, color="black", alpha=0.2)
+    ax.grid(False)
+    ax.set_xlabel('X')
+    ax.set_ylabel('Y')
+    ax.set_zlabel('Z')
+    ax.set_xlim(-L / 2, L / 2)
+    ax.set_ylim(-L / 2, L / 2)
+    ax.set_zlim(-L / 2, L / 2)
+    artists = {}
+    for type_idx, (color, opacity) in particle_styles(args).items():
+        artists[type_idx] = ax.scatter([], [], [], c=color, alpha=opacity)
+    ax.set_title(title)
+    fig.tight_layout()
+    return fig, ax, artists
+
+
+def draw_frame(ax, artists, data, args):
+    """
+    Updates the scatter artists (see create_frame_figure) with the particles of a frame, one batch per particle type.
+    Particles with z > 0 are left out if cut_z.
+    """
+    visible = np.ones(len(data["type"]), dtype=bool)
+    if args.cut_z:
+        visible &= data["z"] <= 0
+    for type_idx, artist in artists.items():
+        mask = visible & (data["type"] == type_idx)
+        # The sizes are set first, set_3d_properties keeps them for the depth sorting of the markers
+        artist.set_sizes(50 * data["radius"][mask])
+        artist.set_offsets(np.column_stack([data["x"][mask], data["y"][mask]]))
+        artist.set_3d_properties(data["z"][mask], "z")
+
+
+def render_image(fig):
+    """
+    Draws a figure on its Agg canvas and returns the image as BGR array (as used by cv2), without any file.
+    """
+    fig.canvas.draw()
+    return cv2.cvtColor(np.asarray(fig.canvas.buffer_rgba()), cv2.COLOR_RGBA2BGR)
+
+
+def create_render_state(folder_path, files, store, args):
+    """
+    Everything needed to render frames of a run (see render_frame): the reused figure with its artists (None for the
+    raster renderer), the .dat files and the trajectory store (None to read the .dat files).
+    """
+    # One figure for all frames, only the particle data of the scatter artists changes from frame to frame
+    folder_label = textwrap.fill(os.path.basename(folder_path), 55)
+    fig, ax, artists = None, None, None
+    if args.renderer == "mplot3d":
+        fig, ax, artists = create_frame_figure(args, title=folder_label + "\n" + "FRAME=0")
+    return {"folder_path": folder_path, "folder_label": folder_label, "files": files, "store": store, "args": args,
+            "fig": fig, "ax": ax, "artists": artists}
+
+
+def render_frame(state, frame_idx):
+    """
+    Renders a frame of a run, see create_render_state, and returns its image.
+    """
+    file = state["files"][frame_idx]
+    print(f"--- {file}")
+    if state["store"] is not None:
+        data = read_store_frame(state["store"], frame_idx)
+    else:
+        data = read_dat(os.path.join(state["folder_path"], file))
+    frame = int(os.path.splitext(os.path.basename(file))[0].split("_")[-1])
+    args = state["args"]
+    if args.renderer == "raster":
+        image = render_raster(data, L=args.L, styles=particle_styles(args), image_size=args.image_size,
+                              slab=args.slab, cut_z=args.cut_z, color_by=args.color_by)
+        cv2.putText(image, f"FRAME={frame}", (5, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 0), 1, cv2.LINE_AA)
+        return image
+    draw_frame(state["ax"], state["artists"], data, args)
+    state["ax"].set_title(state["folder_label"] + "\n" + f"FRAME={frame}")
+    return render_image(state["fig"])
+
+
+def render_frames(folder_path, files, frame_indices, store, args):
+    """
+    Generator of the rendered images of the frames frame_indices, read from the trajectory store (or the .dat files
+    if store is None). Only the image of the current frame is kept in memory.
+    """
+    state = create_render_state(folder_path, files, store, args)
+    for frame_idx in frame_indices:
+        # For each time step
+        yield render_frame(state, frame_idx)
+
+
+# Render state of a frame rendering worker process, see init_render_worker
+worker_render_state = {}
+
+
+def init_render_worker(folder_path, files, args):
+    """
+    Initialises a frame rendering worker process once: its own figure and (read-only) trajectory store.
+    """
+    store = None
+    if is_store_valid(folder_path, files):
+        try:
+            store = map_trajectory_store(os.path.join(folder_path, store_folder_name))
+        except (OSError, ValueError):
+            pass
+    worker_render_state.update(create_render_state(folder_path, files, store, args))
+
+
+def render_frame_chunk(frame_indices):
+    """
+    Renders a chunk of frames in a worker process (see init_render_worker), returns the list of images.
+    """
+    return [render_frame(worker_render_state, frame_idx) for frame_idx in frame_indices]
+
+
+def render_frames_parallel(folder_path, files, frame_indices, args, num_cores):
+    """
+    Generator of the rendered images of the frames frame_indices (see render_frames), rendered in chunks by num_cores
+    worker processes. The images are yielded in frame order, at most 2 x num_cores chunks are rendered ahead of the
+    one that is yielded, so memory stays bounded however long the run.
+    """
+    chunk_size = max(1, min(16, len(frame_indices) // (4 * num_cores)))
+    chunks = [frame_indices[chunk_start:chunk_start + chunk_size] for chunk_start in
+              range(0, len(frame_indices), chunk_size)]
+    max_in_flight = 2 * num_cores
+    with Pool(processes=num_cores, initializer=init_render_worker, initargs=(folder_path, files, args)) as pool:
+        in_flight = deque()
+        for chunk in chunks:
+            if len(in_flight) >= max_in_flight:
+                yield from in_flight.popleft().get()
+            in_flight.append(pool.apply_async(func=render_frame_chunk, args=(chunk,)))
+        while len(in_flight) > 0:
+            yield from in_flight.popleft().get()
+
+
+def plot_particles(folder_path, movie_dir, args, num_cores=1):
+    """
+    Plot all particles as movie (.avi) or snapshot (.png) of the first/last frame in movie_dir. Frames are rendered in
+    memory and streamed into the movie, nothing is written to the SAMoS output folder: frames are read from its
+    trajectory store if it is up to date (e.g. built by the analysis), from the .dat files otherwise.
+    The frames of a movie are rendered by num_cores processes if num_cores > 1.
+    """
     maxframes = args.maxframes
     lastframe = args.lastframe
     firstframe = args.firstframe
-    onlycells = args.onlycells
     cut_z = args.cut_z
     folder_path = os.path.normpath(folder_path)
     movie_dir = os.path.normpath(movie_dir)
     folder_name = os.path.basename(folder_path)
 
-    files = [f for f in os.listdir(folder_path) if f.endswith('.dat')]
-    files.sort()
-    images = []
+    files = list_dat_files(folder_path)
+    # The binary trajectory store is only used if it is up to date, it is never (re)built here
+    store = None
+    if is_store_valid(folder_path, files):
+        try:
+            store = map_trajectory_store(os.path.join(folder_path, store_folder_name))
+        except (OSError, ValueError):
+            print_log(f"-- Could not open binary trajectory of {folder_name}, reading .dat files...")
 
+    frame_indices = list(range(len(files)))
     if lastframe:
         try:
-            files = [files[-1]]
+            frame_indices = [frame_indices[-1]]
         except:
             print("No files present... Aborting!")
             return
     elif firstframe:
         try:
-            files = [files[0]]
+            frame_indices = [frame_indices[0]]
         except:
             print("No files present... Aborting!")
             return
     else:
         if maxframes is not None:
-            files = files[:maxframes]
-    print_log(f"-- Visualising {len(files)} in {folder_name}...")
-    for file in files:
-        # For each time step
-        print(f"--- {file}")
-        data = read_dat(os.path.join(folder_path, file))
-        # Extract data
-        particle_type = data["type"]
-        radius = data["radius"]
-        xyz_positions = data[["x", "y", "z"]]
-        # Plot particles
-        fig = plt.figure(figsize=(5, 5))
-        ax = fig.add_subplot(111, projection='3d')
-        for i in range(len(data)):
-            x, y, z = xyz_positions.iloc[i]
-            if cut_z:
-                if z > 0:
-                    continue
-            # For each particle
-            if onlycells and particle_type[i] != 1:
-                continue
-            if particle_type[i] == 1:
-                color = args.cell_color
-                opacity = args.cell_alpha
-            elif particle_type[i] == 2:
-                color = args.ECM_color
-                opacity = args.ECM_alpha
-            ax.scatter(x, y, z, s=50 * radius[i], c=color, alpha=opacity)
-        frame = int(os.path.splitext(os.path.basename(os.path.join(folder_path, file)))[0].split("_")[-1])
-        folder_label = textwrap.fill(folder_name, 55)
-        plt.title(folder_label + "\n" + f"FRAME={frame}")
-        x, y, z = np.array([[-L / 2, 0, 0], [0, -L / 2, 0], [0, 0, -L / 2]])
-        u, v, w = np.array([[L, 0, 0], [0, L, 0], [0, 0, L]])
-        ax.quiver(x, y, z, u, v, w, arrow_length_ratio=0.1, color="black", alpha=0.2)
-        ax.grid(False)
-        ax.set_xlabel('X')
-        ax.set_ylabel('Y')
-        ax.set_zlabel('Z')
-        ax.set_xlim(-L / 2, L / 2)
-        ax.set_ylim(-L / 2, L / 2)
-        ax.set_zlim(-L / 2, L / 2)
-        # Save as image
-        image_path = os.path.join(folder_path, f"{file}.png")
-        fig.tight_layout()
-        plt.savefig(image_path, dpi=100)
-        images.append(image_path)
-        plt.close()
-
-    if lastframe:
-        print("-- Saving snapshot...")
-        img = cv2.imread(images[-1])
-        height, width, _ = img.shape
-        if cut_z:
-            img_file = os.path.join(movie_dir, f"{folder_name}_cut-z_lastframe.png")
-        else:
-            img_file = os.path.join(movie_dir, f"{folder_name}_lastframe.png")
+            frame_indices = frame_indices[:maxframes]
+    print_log(f"-- Visualising {len(frame_indices)} in {folder_name}...")
+    if num_cores > 1 and len(frame_indices) > 1:
+        images = render_frames_parallel(folder_path, files, frame_indices, args, num_cores)
+    else:
+        images = render_frames(folder_path, files, frame_indices, store, args)
 
-        cv2.imwrite(img_file, img)
-        print_log(f"-- Saving image {img_file}...")
-    elif firstframe:
+    if lastframe or firstframe:
         print("-- Saving snapshot...")
-        img = cv2.imread(images[-1])
-        height, width, _ = img.shape
+        snapshot = "lastframe" if lastframe else "firstframe"
         if cut_z:
-            img_file = os.path.join(movie_dir, f"{folder_name}_cut-z_firstframe.png")
+            img_file = os.path.join(movie_dir, f"{folder_name}_cut-z_{snapshot}.png")
         else:
-            img_file = os.path.join(movie_dir, f"{folder_name}_firstframe.png")
+            img_file = os.path.join(movie_dir, f"{folder_name}_{snapshot}.png")
 
-        cv2.imwrite(img_file, img)
+        cv2.imwrite(img_file, next(images))
         print_log(f"-- Saving image {img_file}...")
     else:
         print("-- Saving movie...")
-        height, width, _ = cv2.imread(images[0]).shape
         movie_file = os.path.join(movie_dir, f"{folder_name}.avi")
-        video = cv2.VideoWriter(movie_file, cv2.VideoWriter_fourcc(*'MJPG'), 10, (width, height))
-
-        for image_path in images:
-            video.write(cv2.imread(image_path))
-        video.release()
-        cv2.destroyAllWindows()
+        video = None
+        for image in images:
+            # The video is opened once the frame size is known
+            if video is None:
+                height, width, _ = image.shape
+                video = cv2.VideoWriter(movie_file, cv2.VideoWriter_fourcc(*'MJPG'), 10, (width, height))
+            video.write(image)
+        if video is not None:
+            video.release()
         print_log(f"-- Saving movie {movie_file}...")
 
-    print("-- Removing cache images...")
-    # Remove individual image files
-    for image_path in images:
-        os.remove(image_path)
-
 
 def main():
     """
@@ -164,12 +262,16 @@ def main():
     parser.add_argument("-firstframe", action="store_true", help="Visualise only first frame?")
     parser.add_argument("-lastframe", action="store_true", help="Visualise only last frame?")
     parser.add_argument("-onlycells", action="store_true", help="Visualise only cells?")
+
+    # Raster renderer: fast orthographic view (top view or slab), see scripts/raster_renderer.py
+    parser.add_argument("-renderer", type=str, default="mplot3d", choices=["mplot3d", "raster"], help="Renderer?")
+    parser.add_argument("-slab", type=float, default=None, help="Raster: only particles within the slab |z| < slab/2?")
+    parser.add_argument("-color_by", type=str, default="type", choices=color_modes, help="Raster: particle colors?")
+    parser.add_argument("-image_size", type=int, default=500, help="Raster: image size in pixels?")
     args = parser.parse_args()
     movie_dir = system_paths["output_movie_dir"]
 
-    processes = []
-    pool = Pool(processes=args.Ncores)
-
+    runs = []
     for session in args.session_folders:
         print(f"- Session {session}")
         folder_paths = [f for f in os.listdir(os.path.join(system_paths["output_samos_dir"], session)) if
@@ -188,8 +290,20 @@ def main():
             except:
                 pass
             for run in samos_run_path:
-                processes.append(pool.apply_async(func=plot_particles, args=(
-                    os.path.join(system_paths["output_samos_dir"], session, folder_path, run), movie_path, args)))
+                runs.append([os.path.join(system_paths["output_samos_dir"], session, folder_path, run), movie_path])
+
+    # Fewer runs than cores and movies of several frames: the runs are rendered one after another, each with all
+    # cores on its frames. Snapshots have a single frame each, so they are rendered by the pool of runs below.
+    frames_per_run = 1 if args.firstframe or args.lastframe else args.maxframes
+    if len(runs) < args.Ncores and (frames_per_run is None or frames_per_run > 1):
+        for run_path, movie_path in runs:
+            plot_particles(run_path, movie_path, args, num_cores=args.Ncores)
+        return
+
+    processes = []
+    pool = Pool(processes=args.Ncores)
+    for run_path, movie_path in runs:
+        processes.append(pool.apply_async(func=plot_particles, args=(run_path, movie_path, args)))
 
     for p in processes:
         p.get()
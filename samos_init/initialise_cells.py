@@ -8,25 +8,24 @@ from datetime import *
 import matplotlib.pyplot as plt
 import numpy as np
 from scripts.communication_handler import print_log
+try:
+    from samos_init.particle_array import new_particles, renumber, set_ball_positions, set_box_positions, \
+        set_random_directions, set_random_radii, particles_to_cells, save_particles, pack_random_sequential, \
+        ball_proposals, box_proposals
+except ImportError:
+    # Archived copy (initialisation.py) in a result folder, next to its copy of particle_array.py
+    from particle_array import new_particles, renumber, set_ball_positions, set_box_positions, \
+        set_random_directions, set_random_radii, particles_to_cells, save_particles, pack_random_sequential, \
+        ball_proposals, box_proposals
 
 
 def save_initial_cells(cells_data, outfile):
     """
-    Writes a .txt file containing the initial particle configuration.
+    Writes a .txt file containing the initial particle configuration, given as particle array or list of cells.
     """
     gentime = datetime.now()
-    out = open(outfile, 'w')
-    out.write('# Total of %s cells\n' % str(len(cells_data)))
-    out.write('# Generated on : %s\n' % str(gentime))
-    out.write('# id  type radius  x   y   z   vx   vy   vz   nx   ny   nz\n')
-    for cell in cells_data:
-        x, y, z = cell.position
-        vx, vy, vz = cell.velocity
-        nx, ny, nz = cell.direction
-        out.write(
-            '%d  %d  %f %f  %f  %f  %f  %f  %f  %f  %f  %f\n' % (
-                cell.idx, cell.type_idx, cell.radius, x, y, z, vx, vy, vz, nx, ny, nz))
-    out.close()
+    header = '# Total of %s cells\n' % str(len(cells_data)) + '# Generated on : %s\n' % str(gentime)
+    save_particles(particles=cells_data, outfile=outfile, header=header)
     print_log(f"Saved cells to {outfile}!")
 
 
@@ -47,74 +46,73 @@ class Cell:
 class Spheroid:
     """
     A spheroid is initialised using a population(collective) of cells.
+    All particles are kept in the structured array particles (see particle_array.py), the list of Cell objects is
+    available as cells. Random numbers are drawn from the numpy Generator rng (a new unseeded one if not given).
+    Packing "random" places all cells uniformly at random, "rsa" places them one by one (random sequential addition)
+    with at most a fraction overlap of overlap between neighbours where possible.
     """
 
-    def __init__(self, cell_count, cell_radius, poly, add_tracker_cells, tracker_cell_count):
+    def __init__(self, cell_count, cell_radius, poly, add_tracker_cells, tracker_cell_count, rng=None,
+                 packing="random", overlap=0.1):
+        if rng is None:
+            rng = np.random.default_rng()
         self.N = int(cell_count)
         self.poly = poly
         self.add_tracker_cells = add_tracker_cells
         self.Ntracker = int(tracker_cell_count)
         self.cell_radius = cell_radius
+        cells = new_particles(self.N, type_idx=1)
+        set_random_radii(cells, rng, self.cell_radius, self.poly)
         if self.add_tracker_cells:
             self.R = ((self.N + self.Ntracker) / 0.74) ** (1 / 3) * self.cell_radius
-            self.cells = [Cell(idx=i, type_idx=1) for i in range(self.N)]
-            self.cells.extend(Cell(idx=j, type_idx=2) for j in range(self.N, self.N + self.Ntracker))
+            trackers = new_particles(self.Ntracker, type_idx=2)
+            trackers["radius"] = self.cell_radius
+            cells = np.concatenate([cells, trackers])
         else:
             self.R = (self.N / 0.74) ** (1 / 3) * self.cell_radius
-            self.cells = [Cell(idx=i, type_idx=1) for i in range(int(self.N))]
-
-        def un(a, b):
-            """
-            Uniform distribution draw between a and b.
-            """
-            return np.random.uniform(a, b)
-
-        for cell in self.cells:
-            phi = un(0, 2 * np.pi)
-            costheta = un(-1, 1)
-            theta = np.arccos(costheta)
-            r = self.R * un(0, 1) ** (1. / 3.)
-            x = r * np.sin(theta) * np.cos(phi)
-            y = r * np.sin(theta) * np.sin(phi)
-            z = r * np.cos(theta)
-
-            vx, vy, vz = 0, 0, 0
-            phi = un(0, 2 * np.pi)
-            costheta = un(-1, 1)
-            nx = np.cos(phi) * np.sin(np.arccos(costheta))
-            ny = np.sin(phi) * np.sin(np.arccos(costheta))
-            nz = costheta
-            if cell.type_idx == 2:
-                cell.radius = self.cell_radius
-            else:
-                cell.radius = self.cell_radius * un(1 - 0.5 * self.poly, 1 + 0.5 * self.poly)
-            cell.position = [x, y, z]
-            cell.velocity = [vx, vy, vz]
-            cell.direction = [nx, ny, nz]
+        self.particles = renumber(cells)
+        set_ball_positions(self.particles, rng, self.R)
+        if packing == "rsa":
+            bad_count, max_overlap = pack_random_sequential(self.particles, rng, ball_proposals(self.R),
+                                                            box=4 * self.R, overlap=overlap)
+            if bad_count > 0:
+                print_log(f"{bad_count} cell(s) placed with overlap above {overlap} (up to {max_overlap:.2f})!")
+        set_random_directions(self.particles, rng)
+
+    @property
+    def cells(self):
+        return particles_to_cells(self.particles, Cell)
 
 
 class Plane:
     """
     A plane is initialised using a population(collective) of cells.
+    All particles are kept in the structured array particles, the list of Cell objects is available as cells.
+    Packing "random" or "rsa" as for a Spheroid, the rsa packing respects the periodic boundaries of the plane.
     """
 
-    def __init__(self, L, phi, cell_radius, poly):
+    def __init__(self, L, phi, cell_radius, poly, rng=None, packing="random", overlap=0.1):
+        if rng is None:
+            rng = np.random.default_rng()
         self.L = L
         self.cell_radius = cell_radius
         self.poly = poly
         self.phi = phi
         area = L ** 2
         self.N = int(self.phi * area / (np.pi * self.cell_radius ** 2))
-        self.cells = [Cell(idx=i, type_idx=1) for i in range(self.N)]
-        for cell in self.cells:
-            x = self.L * np.random.uniform(-0.5, 0.5)
-            y = self.L * np.random.uniform(-0.5, 0.5)
-            z = 0.0
-            alpha = np.random.uniform(0, 2 * np.pi)
-            cell.radius = self.cell_radius * np.random.uniform(1 - 0.5 * self.poly, 1 + 0.5 * self.poly)
-            cell.position = [x, y, z]
-            cell.velocity = [0.0, 0.0, 0.0]
-            cell.direction = [np.cos(alpha), np.sin(alpha), 0.0]
+        self.particles = renumber(new_particles(self.N, type_idx=1))
+        set_box_positions(self.particles, rng, self.L, dimensions=2)
+        set_random_radii(self.particles, rng, self.cell_radius, self.poly)
+        if packing == "rsa":
+            bad_count, max_overlap = pack_random_sequential(self.particles, rng, box_proposals(self.L, dimensions=2),
+                                                            box=[self.L, self.L, 1.0], overlap=overlap, dimensions=2)
+            if bad_count > 0:
+                print_log(f"{bad_count} cell(s) placed with overlap above {overlap} (up to {max_overlap:.2f})!")
+        set_random_directions(self.particles, rng, dimensions=2)
+
+    @property
+    def cells(self):
+        return particles_to_cells(self.particles, Cell)
 
 
 def plot_initial_cells(particles_list):
@@ -8,28 +8,43 @@ from datetime import *
 import matplotlib.pyplot as plt
 import numpy as np
 import argparse
+try:
+    from samos_init.particle_array import new_particles, renumber, set_ball_positions, set_box_positions, \
+        set_random_directions, set_random_radii, particles_to_cells, save_particles, pack_random_sequential, \
+        ball_proposals, box_proposals
+except ImportError:
+    # Archived copy (initialisation.py) in a result folder, next to its copy of particle_array.py
+    from particle_array import new_particles, renumber, set_ball_positions, set_box_positions, \
+        set_random_directions, set_random_radii, particles_to_cells, save_particles, pack_random_sequential, \
+        ball_proposals, box_proposals
 
 
 def save_initial_cells(cells_data, outfile):
     """
-    Writes a .txt file containing the initial particle configuration.
+    Writes a .txt file containing the initial particle configuration, given as particle array or list of cells.
     """
     gentime = datetime.now()
-    out = open(outfile, 'w')
-    out.write('# Total of %s cells\n' % str(len(cells_data)))
-    out.write('# Generated on : %s\n' % str(gentime))
-    out.write('# id  type radius  x   y   z   vx   vy   vz   nx   ny   nz\n')
-    for cell in cells_data:
-        x, y, z = cell.position
-        vx, vy, vz = cell.velocity
-        nx, ny, nz = cell.direction
-        out.write(
-            '%d  %d  %f %f  %f  %f  %f  %f  %f  %f  %f  %f\n' % (
-                cell.idx, cell.type_idx, cell.radius, x, y, z, vx, vy, vz, nx, ny, nz))
-    out.close()
+    header = '# Total of %s cells\n' % str(len(cells_data)) + '# Generated on : %s\n' % str(gentime)
+    save_particles(particles=cells_data, outfile=outfile, header=header)
     print(f"=> Saved {len(cells_data)} particle(s) to {outfile}!")
 
 
+def ecm_particle_count(ecm_phi, ecm_radius, ecm_size):
+    """
+    Number of ECM particles of mean radius ecm_radius that fill a box of size ecm_size to packing fraction ecm_phi.
+    """
+    return int(ecm_phi * ecm_size ** 3 / ((4 / 3) * np.pi * ecm_radius ** 3))
+
+
+def estimate_particle_count(cell_N, cell_radius, ecm_phi, ecm_radius, ecm_size):
+    """
+    Expected number of particles of a Spheroid, without the ECM particles that are removed from inside the spheroid.
+    """
+    spheroid_radius = (int(cell_N) / 0.74) ** (1 / 3) * cell_radius
+    spheroid_fraction = min((4 / 3) * np.pi * spheroid_radius ** 3 / ecm_size ** 3, 1.0)
+    return int(cell_N) + int(ecm_particle_count(ecm_phi, ecm_radius, ecm_size) * (1 - spheroid_fraction))
+
+
 class Cell:
     """
     A single cell is created.
@@ -47,16 +62,30 @@ class Cell:
 class Spheroid:
     """
     A spheroid is initialised using a population(collective) of cells.
+    All particles are kept in the structured array particles (see particle_array.py), the list of Cell objects is
+    available as cells. Random numbers are drawn from the numpy Generator rng (a new unseeded one if not given).
+    Packing "random" places all particles uniformly at random, "rsa" places them one by one (random sequential
+    addition) with at most a fraction overlap of overlap between neighbours where possible.
     """
 
-    def __init__(self, cell_N, cell_radius, cell_poly, ecm_phi, ecm_radius, ecm_poly, ecm_size):
+    def __init__(self, cell_N, cell_radius, cell_poly, ecm_phi, ecm_radius, ecm_poly, ecm_size, rng=None,
+                 packing="random", overlap=0.1):
+        if rng is None:
+            rng = np.random.default_rng()
         # Initialise tumoroid cells
         self.cell_N = int(cell_N)
         self.cell_poly = cell_poly
         self.cell_radius = cell_radius
         self.spheroid_radius = (self.cell_N / 0.74) ** (1 / 3) * self.cell_radius
 
-        self.cells = [Cell(idx=i, type_idx=1) for i in range(int(self.cell_N))]
+        cells = new_particles(self.cell_N, type_idx=1)
+        set_ball_positions(cells, rng, self.spheroid_radius)
+        set_random_radii(cells, rng, self.cell_radius, self.cell_poly)
+        if packing == "rsa":
+            bad_count, max_overlap = pack_random_sequential(cells, rng, ball_proposals(self.spheroid_radius),
+                                                            box=ecm_size, overlap=overlap)
+            if bad_count > 0:
+                print(f"- Cells: {bad_count} placed with overlap above {overlap} (up to {max_overlap:.2f})!")
 
         # Initialise ECM
         self.ecm_radius = ecm_radius
@@ -68,55 +97,29 @@ class Spheroid:
         self.ecm_lz = size_box
         self.ecm_volume = self.ecm_lx * self.ecm_ly * self.ecm_lz
 
-        self.ecm_N = int(self.ecm_phi * self.ecm_volume / ((4 / 3) * np.pi * self.ecm_radius ** 3))
-        self.cells.extend(Cell(idx=j, type_idx=2) for j in range(self.cell_N, self.cell_N + self.ecm_N))
-
-        def un(a, b):
-            """
-            Uniform distribution draw between a and b.
-            """
-            return np.random.uniform(a, b)
-
-        invalid_ecm = []
-        for index, cell in enumerate(self.cells):
-            # Position
-            if cell.type_idx == 2:
-                x = self.ecm_lx * un(-0.5, 0.5)
-                y = self.ecm_ly * un(-0.5, 0.5)
-                z = self.ecm_lz * un(-0.5, 0.5)
-                if x ** 2 + y ** 2 + z ** 2 <= self.spheroid_radius ** 2:
-                    invalid_ecm.append(index)
-            else:
-                phi = un(0, 2 * np.pi)
-                costheta = un(-1, 1)
-                theta = np.arccos(costheta)
-                r = self.spheroid_radius * un(0, 1) ** (1. / 3.)
-                x = r * np.sin(theta) * np.cos(phi)
-                y = r * np.sin(theta) * np.sin(phi)
-                z = r * np.cos(theta)
-            # Velocity
-            vx, vy, vz = 0, 0, 0
-            phi = un(0, 2 * np.pi)
-            costheta = un(-1, 1)
-            nx = np.cos(phi) * np.sin(np.arccos(costheta))
-            ny = np.sin(phi) * np.sin(np.arccos(costheta))
-            nz = costheta
-            # Radius
-            if cell.type_idx == 2:
-                cell.radius = self.ecm_radius * un(1 - 0.5 * self.ecm_poly, 1 + 0.5 * self.ecm_poly)
-            else:
-                cell.radius = self.cell_radius * un(1 - 0.5 * self.cell_poly, 1 + 0.5 * self.cell_poly)
-
-            cell.position = [x, y, z]
-            cell.velocity = [vx, vy, vz]
-            cell.direction = [nx, ny, nz]
-        if len(invalid_ecm) != 0:
-            invalid_ecm.sort(reverse=True)
-            for invalid_ecm_idx in invalid_ecm:
-                del self.cells[invalid_ecm_idx]
-            for idx, cell in enumerate(self.cells):
-                cell.idx = idx
-            print(f"- ECM: Deleted {len(invalid_ecm)}, {self.ecm_N - len(invalid_ecm)} left!")
+        self.ecm_N = ecm_particle_count(ecm_phi=self.ecm_phi, ecm_radius=self.ecm_radius, ecm_size=size_box)
+        ecm = new_particles(self.ecm_N, type_idx=2)
+        set_box_positions(ecm, rng, size_box)
+        set_random_radii(ecm, rng, self.ecm_radius, self.ecm_poly)
+
+        # ECM inside the spheroid is removed
+        invalid_ecm = ecm["x"] ** 2 + ecm["y"] ** 2 + ecm["z"] ** 2 <= self.spheroid_radius ** 2
+        ecm = ecm[~invalid_ecm]
+        if packing == "rsa":
+            # The remaining ECM is packed around the (fixed) cells, outside the spheroid
+            propose = box_proposals(size_box, excluded_radius=self.spheroid_radius)
+            bad_count, max_overlap = pack_random_sequential(ecm, rng, propose, box=size_box, overlap=overlap,
+                                                            fixed=cells)
+            if bad_count > 0:
+                print(f"- ECM: {bad_count} placed with overlap above {overlap} (up to {max_overlap:.2f})!")
+        self.particles = renumber(np.concatenate([cells, ecm]))
+        set_random_directions(self.particles, rng)
+        if np.any(invalid_ecm):
+            print(f"- ECM: Deleted {np.sum(invalid_ecm)}, {self.ecm_N - np.sum(invalid_ecm)} left!")
+
+    @property
+    def cells(self):
+        return particles_to_cells(self.particles, Cell)
 
 
 def plot_initial_cells(particles_list):
@@ -143,6 +146,8 @@ parser.add_argument("-phi_ecm", type=float, default=0.0, help="ECM packing fract
 parser.add_argument("-ecm_size", type=float, default=10, help="ECM packing fraction?")
 parser.add_argument("-r_ecm", type=float, default=1.0, help="ECM radius?")
 parser.add_argument("-poly_ecm", type=float, default=0.3, help="ECM radius poly?")
+parser.add_argument("-packing", type=str, default="random", choices=["random", "rsa"], help="Particle packing?")
+parser.add_argument("-overlap", type=float, default=0.1, help="Maximum relative overlap of rsa packing?")
 parser.add_argument("-plot", action="store_true", help="Plot configuration?")
 
 if __name__ == "__main__":
@@ -150,7 +155,7 @@ if __name__ == "__main__":
 
     all_particles = Spheroid(cell_N=args.N_cell, cell_radius=args.r_cell, cell_poly=args.poly_cell,
                              ecm_phi=args.phi_ecm, ecm_radius=args.r_ecm, ecm_poly=args.poly_ecm,
-                             ecm_size=args.ecm_size).cells
+                             ecm_size=args.ecm_size, packing=args.packing, overlap=args.overlap).cells
 
     save_initial_cells(cells_data=all_particles, outfile="particles.txt")
     if args.plot:
@@ -0,0 +1,272 @@
+"""
+Array based particle initialisation for SAMoS: all particles are stored in one structured numpy array.
+!! This cannot be run independently, it is a helper script.
+Author: Konstantinos Andreadis.
+"""
+import gzip
+import numpy as np
+
+# Columns of the SAMoS particles input file (see save_particles)
+particle_dtype = np.dtype([("id", np.int64), ("type", np.int64), ("radius", np.float64),
+                           ("x", np.float64), ("y", np.float64), ("z", np.float64),
+                           ("vx", np.float64), ("vy", np.float64), ("vz", np.float64),
+                           ("nx", np.float64), ("ny", np.float64), ("nz", np.float64)])
+
+
+def new_particles(count, type_idx=1):
+    """
+    Creates an array of count particles of a given type, at rest in the origin.
+    """
+    particles = np.zeros(int(count), dtype=particle_dtype)
+    particles["type"] = type_idx
+    return particles
+
+
+def renumber(particles):
+    """
+    Sets the particle ids to their index.
+    """
+    particles["id"] = np.arange(len(particles))
+    return particles
+
+
+def set_ball_positions(particles, rng, radius):
+    """
+    Places particles uniformly within a ball of a given radius around the origin.
+    """
+    count = len(particles)
+    phi = rng.uniform(0, 2 * np.pi, count)
+    theta = np.arccos(rng.uniform(-1, 1, count))
+    r = radius * rng.uniform(0, 1, count) ** (1. / 3.)
+    particles["x"] = r * np.sin(theta) * np.cos(phi)
+    particles["y"] = r * np.sin(theta) * np.sin(phi)
+    particles["z"] = r * np.cos(theta)
+
+
+def set_box_positions(particles, rng, size, dimensions=3):
+    """
+    Places particles uniformly within a box [-size/2, size/2) around the origin, in the xy plane if dimensions is 2.
+    """
+    for axis in ["x", "y", "z"][:dimensions]:
+        particles[axis] = size * rng.uniform(-0.5, 0.5, len(particles))
+
+
+def set_random_directions(particles, rng, dimensions=3):
+    """
+    Gives particles a uniformly random unit director, within the xy plane if dimensions is 2.
+    """
+    count = len(particles)
+    phi = rng.uniform(0, 2 * np.pi, count)
+    if dimensions == 2:
+        particles["nx"], particles["ny"], particles["nz"] = np.cos(phi), np.sin(phi), 0.0
+        return
+    costheta = rng.uniform(-1, 1, count)
+    sintheta = np.sin(np.arccos(costheta))
+    particles["nx"] = np.cos(phi) * sintheta
+    particles["ny"] = np.sin(phi) * sintheta
+    particles["nz"] = costheta
+
+
+def set_random_radii(particles, rng, radius, poly):
+    """
+    Gives particles a radius drawn uniformly within radius (1 -/+ poly/2).
+    """
+    particles["radius"] = radius * rng.uniform(1 - 0.5 * poly, 1 + 0.5 * poly, len(particles))
+
+
+def particles_to_cells(particles, cell_class):
+    """
+    Converts a particle array into a list of cell objects (idx, type_idx, radius, position, velocity, direction).
+    """
+    cells = []
+    for particle in particles.tolist():
+        cell = cell_class(idx=particle[0], type_idx=particle[1], radius=particle[2])
+        cell.position = list(particle[3:6])
+        cell.velocity = list(particle[6:9])
+        cell.direction = list(particle[9:12])
+        cells.append(cell)
+    return cells
+
+
+def cells_to_particles(cells):
+    """
+    Converts a list of cell objects (idx, type_idx, radius, position, velocity, direction) into a particle array.
+    """
+    particles = np.zeros(len(cells), dtype=particle_dtype)
+    for column, attribute in [["id", "idx"], ["type", "type_idx"], ["radius", "radius"]]:
+        particles[column] = [getattr(cell, attribute) for cell in cells]
+    for columns, attribute in [[["x", "y", "z"], "position"], [["vx", "vy", "vz"], "velocity"],
+                               [["nx", "ny", "nz"], "direction"]]:
+        values = np.array([getattr(cell, attribute) for cell in cells], dtype=np.float64).reshape(-1, 3)
+        for col_idx, column in enumerate(columns):
+            particles[column] = values[:, col_idx]
+    return particles
+
+
+# Line format of the SAMoS particles input file
+particle_line_format = "%d  %d  %f %f  %f  %f  %f  %f  %f  %f  %f  %f\n"
+
+
+def format_particles(particles):
+    """
+    Formats all particles as lines of the SAMoS particles input file, in one formatting operation.
+    """
+    values = np.column_stack([particles[column].astype(np.float64) for column in particle_dtype.names])
+    return (particle_line_format * len(values)) % tuple(values.ravel().tolist())
+
+
+def save_particles(particles, outfile, header=""):
+    """
+    Writes a particle array (or list of cell objects) as SAMoS particles input file, preceded by the header lines.
+    The file type follows from its extension: ".gz" writes the text file gzip compressed and ".npy" writes the
+    particle array itself, e.g. to archive initial configurations next to the simulation results.
+    """
+    if not isinstance(particles, np.ndarray):
+        particles = cells_to_particles(particles)
+    if outfile.endswith(".npy"):
+        np.save(outfile, particles)
+        return
+    content = header + "# id  type radius  x   y   z   vx   vy   vz   nx   ny   nz\n" + format_particles(particles)
+    if outfile.endswith(".gz"):
+        with gzip.open(outfile, "wt") as out:
+            out.write(content)
+    else:
+        with open(outfile, "w") as out:
+            out.write(content)
+
+
+def columns_to_particles(data):
+    """
+    Converts a dict of column arrays, e.g. a SAMoS .dat dump (see data_handler.read_dat), into a particle array.
+    """
+    particles = new_particles(len(data["id"]))
+    for column in particle_dtype.names:
+        particles[column] = data[column]
+    return particles
+
+
+def load_particles(path):
+    """
+    Reads a particle array from a file written by save_particles (text, gzip compressed text or .npy).
+    """
+    if path.endswith(".npy"):
+        return np.load(path)
+    values = np.loadtxt(path, comments="#", ndmin=2)
+    particles = np.zeros(len(values), dtype=particle_dtype)
+    for column_idx, column in enumerate(particle_dtype.names):
+        particles[column] = values[:, column_idx]
+    return particles
+
+
+def pack_random_sequential(particles, rng, propose, box, overlap=0.1, max_attempts=100, fixed=None, dimensions=3,
+                           attempt_batch=10):
+    """
+    Random sequential addition (largest particles first): each particle (radius set) is placed at the first of
+    max_attempts random positions, drawn in batches of attempt_batch by propose(rng, count) as count x 3 matrix, that
+    overlaps with no earlier particle by more than a fraction overlap of their contact distance a_i + a_j. If there is
+    no such position, the attempt with the least overlap is taken. Fixed particles (e.g. the cells of a spheroid) are
+    obstacles only. The neighbours of a position are looked up in a periodic spatial hash grid (box of size box) of
+    cells at least one particle diameter wide, so each attempt is compared with nearby particles only.
+    !! Random sequential addition jams at a packing fraction near 0.38 (of the radii shrunk by the allowed overlap),
+    denser targets such as a spheroid packed to 0.74 are only reached with particles above the allowed overlap.
+    Returns the number of particles that were placed with more overlap than allowed and the largest overlap reached.
+    """
+    box = np.broadcast_to(np.asarray(box, dtype=np.float64), (3,)).copy()
+    if fixed is None:
+        fixed = new_particles(0)
+    radius = np.concatenate([fixed["radius"], particles["radius"]])
+    if len(radius) == 0:
+        return 0, 0.0
+    positions = np.zeros((len(radius), 3))
+    positions[:len(fixed)] = np.column_stack([fixed["x"], fixed["y"], fixed["z"]])
+
+    # Spatial hash grid: per grid cell a list of (at most capacity) particle indices, -1 if empty
+    grid_shape = np.maximum((box / (2 * np.max(radius))).astype(int), 1)
+    if dimensions == 2:
+        grid_shape[2] = 1
+    cell_width = box / grid_shape
+    grid = np.full(tuple(grid_shape) + (8,), -1, dtype=np.int64)
+    grid_count = np.zeros(tuple(grid_shape), dtype=np.int64)
+    offsets = np.array([[i, j, k] for i in [-1, 0, 1] for j in [-1, 0, 1] for k in ([-1, 0, 1] if dimensions == 3
+                                                                                     else [0])])
+
+    def grid_cell(position):
+        return tuple((np.floor((position + box / 2) / cell_width).astype(int) % grid_shape).tolist())
+
+    def add_to_grid(particle_idx):
+        nonlocal grid
+        cell = grid_cell(positions[particle_idx])
+        if grid_count[cell] == grid.shape[-1]:
+            grid = np.concatenate([grid, np.full(grid.shape, -1, dtype=np.int64)], axis=-1)
+        grid[cell + (grid_count[cell],)] = particle_idx
+        grid_count[cell] += 1
+
+    for particle_idx in range(len(fixed)):
+        add_to_grid(particle_idx)
+
+    bad_count, max_overlap = 0, 0.0
+    order = np.argsort(-particles["radius"], kind="stable")
+    for placed_idx in order:
+        particle_idx = len(fixed) + placed_idx
+        best_position, best_overlap = None, np.inf
+        # Attempts are drawn in small batches, most particles are placed within the first one
+        for batch_start in range(0, max_attempts, attempt_batch):
+            attempts = propose(rng, min(attempt_batch, max_attempts - batch_start))
+            # Neighbouring particles of each attempt (attempts x 27 cells x capacity), -1 for empty places
+            cells = np.floor((attempts + box / 2) / cell_width).astype(int)
+            cells = (cells[:, np.newaxis, :] + offsets) % grid_shape
+            neighbours = grid[cells[..., 0], cells[..., 1], cells[..., 2]].reshape(len(attempts), -1)
+            drvec = positions[neighbours] - attempts[:, np.newaxis, :]
+            drvec -= box * np.rint(drvec / box)
+            distance = np.sqrt(np.sum(np.square(drvec), axis=2))
+            contact = radius[neighbours] + radius[particle_idx]
+            # Relative overlap with each neighbour, the worst one counts for an attempt
+            attempt_overlap = np.max(np.where(neighbours >= 0, 1 - distance / contact, -np.inf), axis=1,
+                                     initial=-np.inf)
+            best = np.argmin(attempt_overlap)
+            valid = np.flatnonzero(attempt_overlap <= overlap)
+            if len(valid) > 0:
+                best = valid[0]
+            if attempt_overlap[best] < best_overlap:
+                best_position, best_overlap = attempts[best], attempt_overlap[best]
+            if best_overlap <= overlap:
+                break
+        if best_overlap > overlap:
+            bad_count += 1
+        max_overlap = max(max_overlap, float(best_overlap))
+        positions[particle_idx] = best_position
+        add_to_grid(particle_idx)
+
+    particles["x"], particles["y"], particles["z"] = positions[len(fixed):].T
+    return bad_count, max_overlap
+
+
+def ball_proposals(radius):
+    """
+    Proposal of uniformly random positions within a ball around the origin (see pack_random_sequential).
+    """
+
+    def propose(rng, count):
+        proposals = new_particles(count)
+        set_ball_positions(proposals, rng, radius)
+        return np.column_stack([proposals["x"], proposals["y"], proposals["z"]])
+
+    return propose
+
+
+def box_proposals(size, dimensions=3, excluded_radius=0.0):
+    """
+    Proposal of uniformly random positions within a box around the origin, outside a ball of radius excluded_radius
+    (see pack_random_sequential).
+    """
+
+    def propose(rng, count):
+        positions = np.zeros((count, 3))
+        positions[:, :dimensions] = size * rng.uniform(-0.5, 0.5, (count, dimensions))
+        outside = np.sum(np.square(positions), axis=1) > excluded_radius ** 2
+        if not np.any(outside):
+            return positions
+        # Attempts inside the excluded ball are replaced by ones outside of it
+        return positions[outside][np.arange(count) % np.sum(outside)]
+
+    return propose
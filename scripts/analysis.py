@@ -18,32 +18,93 @@ def calc_radius_gyration(xyz):
 
 def cm_removal(tnxyz):
     """
-    Removes the center of mass for a set of xyz coordinates given as numpy matrix txNx3
+    Removes the center of mass for a set of xyz coordinates given as numpy matrix txNx3, in place.
+    As before, particles are weighted by their distance to the origin.
     """
-    tr = np.sqrt(np.sum(np.square(tnxyz), axis=2))
-    txyz_cm = np.zeros_like(tnxyz)
-    for t_i, xyz in enumerate(tnxyz):
-        txyz_cm[t_i] = np.average(xyz, axis=0, weights=tr[t_i])
-    tnxyz -= txyz_cm
+    tr = np.sqrt(np.einsum("tnk,tnk->tn", tnxyz, tnxyz))
+    txyz_cm = np.einsum("tn,tnk->tk", tr, tnxyz) / np.sum(tr, axis=1)[:, np.newaxis]
+    tnxyz -= txyz_cm[:, np.newaxis, :]
     return tnxyz
 
 
-def periodic_unwrap(tnxyz, L):
+def periodic_unwrap(tnxyz, L, chunk_size=64):
     """
     According to box size and periodicity (L), this function "unwraps" a set of xyz coordinates
-    given as numpy matrix txNx3
+    given as numpy matrix txNx3, in place. The minimum-image displacements between frames are summed cumulatively,
+    working on chunks of chunk_size frames so that no full-size temporary copy is made.
     """
-    for t_i in range(1, tnxyz.shape[0]):
-        nxyz_diff = tnxyz[t_i] - tnxyz[t_i - 1]
-        tnxyz[t_i, nxyz_diff <= -L / 2] += L
-        tnxyz[t_i, nxyz_diff >= L / 2] -= L
+    if tnxyz.shape[0] < 2:
+        return tnxyz
+    previous = tnxyz[0].copy()
+    image_shift = np.zeros_like(previous)
+    for t_start in range(1, tnxyz.shape[0], chunk_size):
+        chunk = tnxyz[t_start:t_start + chunk_size]
+        # Number of box crossings between consecutive (wrapped) frames
+        crossings = np.empty_like(chunk)
+        np.subtract(chunk[0], previous, out=crossings[0])
+        np.subtract(chunk[1:], chunk[:-1], out=crossings[1:])
+        previous = chunk[-1].copy()
+        crossings /= L
+        np.rint(crossings, out=crossings)
+        # Accumulated image shift of each frame
+        np.cumsum(crossings, axis=0, out=crossings)
+        crossings *= -L
+        crossings += image_shift
+        image_shift = crossings[-1].copy()
+        chunk += crossings
     return tnxyz
 
 
-def calc_msd(tnxyz, L, t, tau, freqdt, substract_CM=False, debug=False):
+def msd_fft(tnxyz, chunk_size=1024):
+    """
+    Mean squared displacement for all lag indices m = 0..t-1 of a set of xyz coordinates given as numpy matrix txNx3,
+    averaged over all particles and time origins. Uses the FFT (Wiener-Khinchin) form MSD(m) = S1(m) - 2 S2(m), where
+    S2 is the positional autocorrelation. Particles are processed in chunks of chunk_size to limit memory.
+    """
+    n_t, n_particles = tnxyz.shape[0], tnxyz.shape[1]
+    # S1: sum over origins k of |r(k)|^2 + |r(k+m)|^2, particle averaged
+    r2 = np.mean(np.sum(np.square(tnxyz, dtype=np.float64), axis=2), axis=1)
+    r2_cumsum = np.concatenate([[0.0], np.cumsum(r2)])
+    m = np.arange(n_t)
+    s1 = r2_cumsum[n_t - m] + (r2_cumsum[n_t] - r2_cumsum[m])
+    # S2: autocorrelation sum over origins k of r(k).r(k+m), the power spectrum is summed over particles and axes
+    power = np.zeros(n_t + 1)
+    for p_start in range(0, n_particles, chunk_size):
+        spectrum = np.fft.rfft(tnxyz[:, p_start:p_start + chunk_size].astype(np.float64), n=2 * n_t, axis=0)
+        power += np.sum(np.square(spectrum.real) + np.square(spectrum.imag), axis=(1, 2))
+    s2 = np.fft.irfft(power, n=2 * n_t)[:n_t] / n_particles
+    return (s1 - 2 * s2) / (n_t - m)
+
+
+def msd_origin_std(tnxyz, lag_idx, max_origins=256, chunk_size=64):
+    """
+    Standard deviation over time origins of the particle averaged squared displacement, at the lag indices lag_idx of
+    a set of xyz coordinates given as numpy matrix txNx3. Per lag at most max_origins evenly spaced time origins are
+    used (all of them for shorter trajectories), in chunks of chunk_size origins, so the cost is bounded by
+    O(len(lag_idx) x max_origins x N) instead of O(t^2 N) for all lags and origins.
+    """
+    n_t = tnxyz.shape[0]
+    std = np.full(len(lag_idx), np.nan)
+    for i, m in enumerate(lag_idx):
+        if m >= n_t:
+            continue
+        origins = np.unique(np.round(np.linspace(0, n_t - m - 1, min(max_origins, n_t - m))).astype(int))
+        sd_sum, sd_sqsum = 0.0, 0.0
+        for o_start in range(0, len(origins), chunk_size):
+            k = origins[o_start:o_start + chunk_size]
+            displacement = tnxyz[k + m].astype(np.float64) - tnxyz[k]
+            sd = np.mean(np.sum(np.square(displacement), axis=2), axis=1)
+            sd_sum += np.sum(sd)
+            sd_sqsum += np.sum(np.square(sd))
+        std[i] = np.sqrt(max(sd_sqsum / len(origins) - (sd_sum / len(origins)) ** 2, 0.0))
+    return std
+
+
+def calc_msd(tnxyz, L, t, tau, freqdt, substract_CM=False, debug=False, log_lags=False, num_lags=50):
     """
     Calculates the mean squared displacement (MSD) as a function of time for a set of xyz
-    coordinates given as numpy matrix txNx3
+    coordinates given as numpy matrix txNx3, with frames equally spaced by freqdt. All lags are evaluated at once by
+    msd_fft, with log_lags=True only ~num_lags log-spaced lag times are returned instead of a linear range.
     """
     if substract_CM:
         tnxyz = cm_removal(tnxyz)
@@ -54,56 +115,27 @@ def calc_msd(tnxyz, L, t, tau, freqdt, substract_CM=False, debug=False):
     else:
         delta_t_sep = freqdt
 
-    delta_t = np.arange(freqdt, np.max(t), delta_t_sep)
+    t_max = np.max(t)
+    if log_lags:
+        lag_idx = np.unique(np.round(np.logspace(0, np.log10(max(t_max / freqdt - 1, 1)), num_lags)).astype(int))
+        delta_t = lag_idx * freqdt
+    else:
+        delta_t = np.arange(freqdt, t_max, delta_t_sep)
+        lag_idx = np.round(delta_t / freqdt).astype(int)
 
     if debug:
         print("tau:", tau)
         print("freq*dt:", freqdt)
         print("t:", t)
         print("delta_t:", delta_t)
-    tmsd = []
-    tmsderr = []
-    for delta_t_i, delta_t_val in enumerate(delta_t):
-        if debug:
-            print("Delta t:", delta_t_val)
-        msd_delta_t = []
-        for t_val in t:
-            if t_val + delta_t_val <= np.max(t):
-                t_val_index = t_val / freqdt
-                delta_t_val_index = delta_t_val / freqdt
-                displacement = np.linalg.norm(tnxyz[int(t_val_index + delta_t_val_index)] - tnxyz[int(t_val_index)],
-                                              axis=1)
-                msd_delta_t.append(np.mean(np.square(displacement)))
-        msd_delta_t = np.asarray(msd_delta_t)
-        tmsd.append(np.mean(msd_delta_t))
-        tmsderr.append(np.std(msd_delta_t) / np.sqrt(len(msd_delta_t)))
+
+    n_origins = tnxyz.shape[0] - lag_idx
+    tmsd = msd_fft(tnxyz)[lag_idx]
+    tmsderr = msd_origin_std(tnxyz, lag_idx) / np.sqrt(n_origins)
 
     if debug:
         print("tmsd:", tmsd)
 
-    # delta_t = np.unique(np.round((np.logspace(0, round(np.log10(np.max(t))) - 1, endpoint=False))).astype(
-    #     int) * freqdt)
-    #
-    # if freqdt > tau:
-    #     tau = freqdt
-    # tau = 10 ** np.floor(np.log10(tau))
-    # t0 = np.arange(0, np.max(t) - np.max(delta_t) + 1, tau)
-    #
-    # tmsd = []
-    # for delta_t_i, delta_t_val in enumerate(delta_t):
-    #     msd_t0 = np.empty_like(t0)
-    #     for t0_i, t0_val in enumerate(t0):
-    #         t0_idx = np.isclose(t, t0_val).nonzero()[0]
-    #         t0_delta_t_idx = np.isclose(t, t0_val + delta_t_val).nonzero()[0]
-    #         msd_t0[t0_i] = np.mean(np.square(np.linalg.norm(tnxyz[t0_delta_t_idx] - tnxyz[t0_idx], axis=2)), axis=1)
-    #
-    #     # print(delta_t_i, np.mean(msd_t0))
-    #     tmsd.append(np.mean(msd_t0))
-    # tmsd = np.asarray(tmsd)
-
-    # tmsd = np.mean(np.square(np.linalg.norm(tnxyz - tnxyz[0], axis=2)), axis=1)
-    # delta_t = t
-
     return delta_t, tmsd, tmsderr
 
 
@@ -117,25 +149,52 @@ def calc_r(xyz):
     return np.sqrt(np.sum(np.square(xyz), axis=1))
 
 
-def calc_phi(r, radius):
+def calc_phi_frames(r_frames, radius_frames):
     """
-    Calculates the density profile for a set of distances (wrt. C.M.) and radii, both numpy matrices with length N
+    Calculates the density profiles of several frames in one batched call, for lists of distances (wrt. C.M.) and
+    radii (numpy matrices with length N per frame). Per frame, shells of width dr = 2 <radius> are centered at
+    r_bins = dr, 2 dr, ... and include both edges, so a particle exactly on an edge counts in both shells. Particle
+    volumes are summed per shell with np.bincount. Returns lists of r_bins, phi (normalised to its maximum), r_core
+    and r_invasion.
     """
-    if len(r) == 1:
-        return np.array([]), np.array([]), None, None
-    else:
-        r_max = np.max(r)
-        dr = 2 * np.average(radius)
-        r_bins = np.arange(dr, r_max + dr, dr)
-        shell_surface = 4 * np.pi * r_bins ** 2
-        shell_volume = dr * shell_surface
-        in_shell = (r_bins - dr / 2 <= r[:, np.newaxis]) & (r[:, np.newaxis] <= r_bins + dr / 2)
-        particles_volume = np.einsum("ij, i->j", in_shell, (4 / 3) * np.pi * radius ** 3)
-        phi = particles_volume / shell_volume
-        phi /= np.max(phi)
-        try:
-            r_core = min(r_bins[phi <= 1 / np.e])
-        except:
-            r_core = None
-        r_invasion = r_max
-        return r_bins, phi, r_core, r_invasion
+    n_frames = len(r_frames)
+    counts = np.array([len(r) for r in r_frames])
+    r_bins_frames, phi_frames = [np.array([]) for _ in range(n_frames)], [np.array([]) for _ in range(n_frames)]
+    r_core_frames, r_invasion_frames = [None] * n_frames, [None] * n_frames
+    profiled = np.flatnonzero(counts > 1)
+    if len(profiled) == 0:
+        return r_bins_frames, phi_frames, r_core_frames, r_invasion_frames
+
+    frame_idx = np.repeat(np.arange(len(profiled)), counts[profiled])
+    r = np.concatenate([r_frames[f] for f in profiled])
+    radius = np.concatenate([radius_frames[f] for f in profiled])
+    r_max = np.array([np.max(r_frames[f]) for f in profiled])
+    dr = 2 * np.bincount(frame_idx, weights=radius) / counts[profiled]
+    r_bins_list = [np.arange(dr_f, r_max_f + dr_f, dr_f) for dr_f, r_max_f in zip(dr, r_max)]
+    n_bins = np.array([len(r_bins) for r_bins in r_bins_list])
+    bin_offsets = np.concatenate([[0], np.cumsum(n_bins)])
+    r_bins = np.concatenate(r_bins_list)
+
+    # Each particle lies in the shell of its nearest bin center, or in a neighbouring one when exactly on an edge
+    dr_p = dr[frame_idx]
+    k_nearest = np.floor((r - dr_p / 2) / dr_p).astype(int)
+    particles_volume = np.zeros(len(r_bins))
+    volume = (4 / 3) * np.pi * radius ** 3
+    for k_shift in [-1, 0, 1]:
+        k = k_nearest + k_shift
+        valid = (k >= 0) & (k < n_bins[frame_idx])
+        global_k = bin_offsets[frame_idx[valid]] + k[valid]
+        in_shell = (r_bins[global_k] - dr_p[valid] / 2 <= r[valid]) & (r[valid] <= r_bins[global_k] + dr_p[valid] / 2)
+        particles_volume += np.bincount(global_k[in_shell], weights=volume[valid][in_shell], minlength=len(r_bins))
+
+    shell_volume = np.repeat(dr, n_bins) * 4 * np.pi * r_bins ** 2
+    phi = particles_volume / shell_volume
+    phi /= np.repeat(np.maximum.reduceat(phi, bin_offsets[:-1]), n_bins)
+
+    for i, f in enumerate(profiled):
+        r_bins_frames[f] = r_bins[bin_offsets[i]:bin_offsets[i + 1]]
+        phi_frames[f] = phi[bin_offsets[i]:bin_offsets[i + 1]]
+        r_core = r_bins_frames[f][phi_frames[f] <= 1 / np.e]
+        r_core_frames[f] = np.min(r_core) if len(r_core) > 0 else None
+        r_invasion_frames[f] = r_max[i]
+    return r_bins_frames, phi_frames, r_core_frames, r_invasion_frames
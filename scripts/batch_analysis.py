@@ -5,182 +5,274 @@ Author: Konstantinos Andreadis
 """
 import os
 import numpy as np
+from collections import deque
 
 from paths_init import system_paths
-from scripts.data_handler import dict2dataframe, dataframe2csv, read_dat, read_xyz, add_result, add_vars, read_radii, \
-    read_vel, import_resultdf, read_dr_l, read_params_dict
-from scripts.visualisation import plot_lineplot, plot_profile, plot_msd
-from scripts.analysis import calc_radius_gyration, calc_r, calc_phi, calc_msd
+from scripts.data_handler import dict2dataframe, dataframe2csv, dataframe2store, read_xyz, add_result, add_vars, \
+    read_radii, read_vel, import_resultdf, read_dr_l, read_params_dict, save_run_cache, read_run_cache
+from scripts.trajectory_store import stream_trajectory, list_dat_files, dat_files_status
+from scripts.visualisation import plot_lineplot, plot_profile, plot_msd, run_plot_jobs
+from scripts.analysis import calc_radius_gyration, calc_r, calc_phi_frames, calc_msd
+from scripts.mechanics import read_mechanics_params, analyse_mechanics
 from scripts.communication_handler import print_log, visualise_result_tree, print_progressbar
 from multiprocessing import Pool
 
+# Version of the analysis code, increase when the results change so that cached run results are recomputed
+analysis_version = 1
 
-def analyse_folder(session_folder, type_analysis, root, vars_select, result_folder, dt, freq, debug, dat_iter_debug,
-                   idx_iter_debug):
+
+def list_run_folders(root, session_folder):
     """
-    For a folder within ../figures/root/session_folder, all SAMoS output folders are analysed by their .dat files.
+    Sorted list of all SAMoS output (run) folders within root/session_folder.
     """
-    print_log(f"Looking for folder vars {list(vars_select.keys())}...")
-    analysis_output_dir = system_paths["output_analysis_dir"]
-    res_root_dir = os.path.join(analysis_output_dir, result_folder, session_folder)
-
-    # Directory management
     result_folder_path = os.path.join(root, session_folder)
-    analysis_result_dict = {}
-    msd_dict = {}
-    ossearch = sorted(os.listdir(result_folder_path))
-    result_folder_subdirs = []
-    for i, folder in enumerate(ossearch):
-        if os.path.isdir(os.path.join(root, session_folder, folder)):
-            result_folder_subdirs.append(folder)
+    return [folder for folder in sorted(os.listdir(result_folder_path)) if
+            os.path.isdir(os.path.join(result_folder_path, folder))]
 
-    result_folder_subdirs_num = len(result_folder_subdirs)
-    print_log(f"-- Found {result_folder_subdirs_num} folders, starting analysis !")
 
-    # Loop through all SAMoS output folders
-    for idx, output_dir in enumerate(result_folder_subdirs):
-        print_progressbar(idx=idx, idxmax=result_folder_subdirs_num)
-        folder_path = os.path.join(result_folder_path, output_dir)
-
-        params = read_params_dict(path=folder_path)
+def run_manifest(folder_path, dat_files, type_analysis, vars_select, dt, freq, msd_log_lags):
+    """
+    Everything the analysis results of a run depend on: the .dat files (name, mtime, size), the SAMoS configuration,
+    the analysis parameters and the code version.
+    """
+    conf_status = None
+    if os.path.isfile(os.path.join(folder_path, "configuration.conf")):
+        conf_status = dat_files_status(folder_path, ["configuration.conf"])
+    return {"version": analysis_version, "files": dat_files_status(folder_path, dat_files),
+            "configuration": conf_status, "type_analysis": type_analysis, "dt": dt, "freq": freq,
+            "msd_log_lags": msd_log_lags, "vars_select": list(vars_select.keys())}
 
-        dat_files = [f for f in sorted(os.listdir(folder_path)) if f.endswith(".dat")]
 
-        # If folder is empty, continue to next one
-        if len(dat_files) == 0: continue
+def analyse_run(folder_path, type_analysis, vars_select, dt, freq, debug, dat_iter_debug, msd_log_lags=False,
+                cache_dir=None):
+    """
+    Analyses a single SAMoS output (run) folder by its .dat files.
+    Returns the per frame measurements and the MSD of this run as two result dicts, None if the folder is empty.
+    If a cache_dir is given, the results are cached there with a manifest and reused as long as the run is unchanged.
+    Frames appended since (still running simulation) are analysed on their own, only the MSD is recomputed.
+    """
+    output_dir = os.path.basename(folder_path)
+    analysis_result_dict = {}
+    msd_dict = {}
 
-        # Find all parameters inside folder name
-        var_list = output_dir.split("_")
+    params = read_params_dict(path=folder_path)
+
+    dat_files = list_dat_files(folder_path)
+
+    # If folder is empty, there is nothing to analyse
+    if len(dat_files) == 0: return None
+
+    # Reuse cached results (not in debug mode, where only a part of the frames is analysed)
+    use_cache = cache_dir is not None and dat_iter_debug is None
+    first_frame = 0
+    if use_cache:
+        manifest = run_manifest(folder_path=folder_path, dat_files=dat_files, type_analysis=type_analysis,
+                                vars_select=vars_select, dt=dt, freq=freq, msd_log_lags=msd_log_lags)
+        cache = read_run_cache(cache_dir=cache_dir)
+        if cache is not None:
+            cached_manifest = cache["manifest"]
+            cached_files = cached_manifest["files"]
+            same_params = all(cached_manifest.get(key) == manifest[key] for key in manifest if key != "files")
+            if same_params and manifest["files"][:len(cached_files)] == cached_files:
+                if len(cached_files) == len(manifest["files"]):
+                    if debug: print_log(f"-- {output_dir} is up to date, using cached results")
+                    return cache["results"], cache["msd"]
+                analysis_result_dict = cache["results"]
+                first_frame = len(cached_files)
+                if debug: print_log(f"-- {output_dir}: analysing {len(dat_files) - first_frame} new frames")
+
+    # Find all parameters inside folder name
+    var_list = output_dir.split("_")
+
+    Dr, L = read_dr_l(var_list=var_list)
+
+    # Mechanics parameters (box, neighbour list, pair potentials) from the SAMoS configuration of this run
+    mechanics_params = None
+    if type_analysis != "plane":
+        try:
+            mechanics_params = read_mechanics_params(conf_path=os.path.join(folder_path, "configuration.conf"))
+        except (OSError, ValueError, KeyError):
+            print_log(f"-- No valid configuration.conf in {output_dir}, skipping mechanics...")
+
+    # ***********************************************************
+    # *    Single pass over all time frames (.dat files)        *
+    # ***********************************************************
+    # Each frame is read once (from the binary trajectory store) and handed to both the static analysis and the
+    # MSD trajectory, of which only the cell positions are kept in memory.
+    xyz = []
+    t = []
+    # Per frame results, the density profiles of all frames are added after the pass in one batched calculation
+    frame_results = []
+    r_cells_frames, radii_cells_frames, r_ecm_frames, radii_ecm_frames = [], [], [], []
+    for dat_iter, (dat_dir, time_index, dat_content) in enumerate(
+            stream_trajectory(folder_path=folder_path, dat_files=dat_files, max_iter=dat_iter_debug)):
+        if debug and (dat_iter % 100 == 0):
+            print_log(f"  {len(dat_files) - dat_iter} .dat files left...")
+        xyz_cells = read_xyz(data=dat_content, group_index=1)
+        xyz.append(xyz_cells.copy())
+        t.append(time_index)
+        # Only the MSD needs the frames that were analysed before
+        if dat_iter < first_frame: continue
 
         # ***********************************************************
-        # *    Dynamic Analysis (MSD)                               *
+        # *     Static Analysis (Radial density profile, etc..)     *
         # ***********************************************************
-        Dr, L = read_dr_l(var_list=var_list)
-        if debug: print_log(f"-- MSD analysis Dr: {Dr} L: {L}...")
-
-        # Extract the xyz positions for each time frame (.dat file)
-        xyz = []
-        t = []
-        for dat_iter, dat_dir in enumerate(dat_files):
-            if debug and (dat_iter % 100 == 0):
-                print_log(f"  {len(dat_files) - dat_iter} .dat files left...")
-            dat_file_dir = os.path.join(result_folder_path, output_dir, dat_dir)
-            dat_content = read_dat(path=dat_file_dir)
-            xyz.append(read_xyz(data=dat_content, group_index=1))
-            time_index = int(os.path.splitext(os.path.basename(dat_file_dir))[0].split("_")[-1])
-            t.append(time_index)
-            if dat_iter == dat_iter_debug: break
-
-        # Rescale the time range
-        t = np.asarray(t)
-        t = (t - np.min(t)) * dt
-        txyz = np.stack(xyz, axis=0)
-
-        # If only 1 particle is present or 2D plane analysis, don't substract CM!
-        if txyz.shape[1] == 1 or type_analysis == "plane":
-            delta_t, msd, msderr = calc_msd(tnxyz=txyz, L=L, t=t, tau=1 / Dr, freqdt=freq * dt, debug=debug,
-                                            substract_CM=False)
+        frame_result = {"dir": output_dir, ".data dir": dat_dir, "time": time_index}
+        if type_analysis == "plane":
+            vel_cells = read_vel(data=dat_content, group_index=1)
+            frame_result["average velocity"] = np.average(np.sqrt(np.sum(np.square(vel_cells), axis=1)), axis=0)
         else:
-            delta_t, msd, msderr = calc_msd(tnxyz=txyz, L=L, t=t, tau=1 / Dr, freqdt=freq * dt, debug=debug,
-                                            substract_CM=True)
-
-        # Save MSD measurements
-        for delta_t_i in range(len(delta_t)):
-            add_result(target=msd_dict, tag="lag time", item=delta_t[delta_t_i])
-            add_result(target=msd_dict, tag="MSD", item=msd[delta_t_i])
-            add_result(target=msd_dict, tag="MSD/t", item=msd[delta_t_i] / delta_t[delta_t_i])
-            add_result(target=msd_dict, tag="MSD error", item=msderr[delta_t_i])
-            add_result(target=msd_dict, tag="freq", item=freq)
-            add_result(target=msd_dict, tag="dt", item=dt)
-            if "Dr" not in var_list:
-                add_result(target=msd_dict, tag="Dr", item=Dr)
-            add_vars(target=msd_dict, var_list=var_list, vars_select=vars_select)
+            frame_result["cell count"] = len(xyz_cells)
+            frame_result["ECM count"] = len(dat_content["type index"][2])
+            # calc_r removes the C.M. in place, so the radius of gyration is taken wrt. the C.M.
+            r_cells_frames.append(calc_r(xyz_cells))
+            frame_result["radius of gyration"] = calc_radius_gyration(xyz=xyz_cells)
+            radii_cells_frames.append(read_radii(data=dat_content, group_index=1))
+            r_ecm_frames.append(calc_r(read_xyz(data=dat_content, group_index=2)))
+            radii_ecm_frames.append(read_radii(data=dat_content, group_index=2))
+
+            # Mechanics: average passive/active pressure per particle group
+            for group_label in ["cells", "ECM"]:
+                for kind in ["passive", "active"]:
+                    frame_result[f"{kind} pressure {group_label}"] = None
+            if mechanics_params is not None:
+                mechanics = analyse_mechanics(data=dat_content, params=mechanics_params)
+                for group_label, group_index in [["cells", 1], ["ECM", 2]]:
+                    rows = dat_content["type index"].get(group_index, [])
+                    for kind in ["passive", "active"]:
+                        if len(rows) > 0:
+                            frame_result[f"{kind} pressure {group_label}"] = np.mean(
+                                mechanics[f"{kind} pressure"][rows])
+        frame_results.append(frame_result)
+
+    # Density profiles of all frames at once
+    if type_analysis != "plane":
+        r_cells_binned, phi_cells, r_cells_core, r_cell_invasion = calc_phi_frames(r_cells_frames,
+                                                                                   radii_cells_frames)
+        r_ecm_binned, phi_ecm, _, _ = calc_phi_frames(r_ecm_frames, radii_ecm_frames)
+        del r_cells_frames, radii_cells_frames, r_ecm_frames, radii_ecm_frames
+
+    # Add found results
+    for frame_idx, frame_result in enumerate(frame_results):
+        add_result(target=analysis_result_dict, tag="dir", item=frame_result["dir"])
+        add_result(target=analysis_result_dict, tag=".data dir", item=frame_result[".data dir"])
+        add_result(target=analysis_result_dict, tag="time", item=frame_result["time"])
+
+        if type_analysis == "plane":
+            add_result(target=analysis_result_dict, tag="average velocity", item=frame_result["average velocity"])
+        else:
+            add_result(target=analysis_result_dict, tag="cell count", item=frame_result["cell count"])
+            add_result(target=analysis_result_dict, tag="ECM count", item=frame_result["ECM count"])
+            add_result(target=analysis_result_dict, tag="radius of gyration",
+                       item=frame_result["radius of gyration"])
+
+            add_result(target=analysis_result_dict, tag="r cells", item=r_cells_binned[frame_idx].tolist())
+            add_result(target=analysis_result_dict, tag="phi cells", item=phi_cells[frame_idx].tolist())
+            add_result(target=analysis_result_dict, tag="radius of core", item=r_cells_core[frame_idx])
+            add_result(target=analysis_result_dict, tag="radius of invasion", item=r_cell_invasion[frame_idx])
+
+            add_result(target=analysis_result_dict, tag="r ECM", item=r_ecm_binned[frame_idx].tolist())
+            add_result(target=analysis_result_dict, tag="phi ECM", item=phi_ecm[frame_idx].tolist())
+
+            for group_label in ["cells", "ECM"]:
+                for kind in ["passive", "active"]:
+                    tag = f"{kind} pressure {group_label}"
+                    add_result(target=analysis_result_dict, tag=tag, item=frame_result[tag])
+
+            add_vars(target=analysis_result_dict, var_list=var_list, vars_select=vars_select)
+
+    # ***********************************************************
+    # *    Dynamic Analysis (MSD)                               *
+    # ***********************************************************
+    if debug: print_log(f"-- MSD analysis Dr: {Dr} L: {L}...")
+
+    # Rescale the time range
+    t = np.asarray(t)
+    t = (t - np.min(t)) * dt
+    txyz = np.stack(xyz, axis=0)
+    del xyz
+
+    # If only 1 particle is present or 2D plane analysis, don't substract CM!
+    if txyz.shape[1] == 1 or type_analysis == "plane":
+        delta_t, msd, msderr = calc_msd(tnxyz=txyz, L=L, t=t, tau=1 / Dr, freqdt=freq * dt, debug=debug,
+                                        substract_CM=False, log_lags=msd_log_lags)
+    else:
+        delta_t, msd, msderr = calc_msd(tnxyz=txyz, L=L, t=t, tau=1 / Dr, freqdt=freq * dt, debug=debug,
+                                        substract_CM=True, log_lags=msd_log_lags)
+
+    # Save MSD measurements
+    for delta_t_i in range(len(delta_t)):
+        add_result(target=msd_dict, tag="lag time", item=delta_t[delta_t_i])
+        add_result(target=msd_dict, tag="MSD", item=msd[delta_t_i])
+        add_result(target=msd_dict, tag="MSD/t", item=msd[delta_t_i] / delta_t[delta_t_i])
+        add_result(target=msd_dict, tag="MSD error", item=msderr[delta_t_i])
+        add_result(target=msd_dict, tag="freq", item=freq)
+        add_result(target=msd_dict, tag="dt", item=dt)
+        if "Dr" not in var_list:
+            add_result(target=msd_dict, tag="Dr", item=Dr)
+        add_vars(target=msd_dict, var_list=var_list, vars_select=vars_select)
+
+    if use_cache:
+        save_run_cache(cache_dir=cache_dir, cache={"manifest": manifest, "results": analysis_result_dict,
+                                                   "msd": msd_dict})
+    return analysis_result_dict, msd_dict
+
+
+def merge_results(target, source):
+    """
+    Appends all results of a source result dictionary to a target dictionary.
+    """
+    for tag, items in source.items():
+        for item in items:
+            add_result(target=target, tag=tag, item=item)
 
-        # ***********************************************************
-        # *     Static Analysis (Radial density profile, etc..)     *
-        # ***********************************************************
-        if debug: print_log("Static analysis...")
-        for dat_iter, dat_dir in enumerate(dat_files):
-            # Performed for each timestep (.dat file)
-            dat_file_dir = os.path.join(result_folder_path, output_dir, dat_dir)
-            dat_content = read_dat(path=dat_file_dir)
-            time_index = int(os.path.splitext(os.path.basename(dat_file_dir))[0].split("_")[-1])
-            xyz_cells = read_xyz(data=dat_content, group_index=1)
-
-            if type_analysis == "plane":
-                vel_cells = read_vel(data=dat_content, group_index=1)
-                avg_vel = np.average(np.sqrt(np.sum(np.square(vel_cells), axis=1)), axis=0)
-            else:
-                radii_cells = read_radii(data=dat_content, group_index=1)
-                cell_count = len(xyz_cells)
-                r_cells = calc_r(xyz_cells)
-                r_cells_binned, phi_cells, r_cells_core, r_cell_invasion = calc_phi(r_cells, radii_cells)
-                r_gyration_cells = calc_radius_gyration(xyz=xyz_cells)
-
-                xyz_ecm = read_xyz(data=dat_content, group_index=2)
-                ecm_count = len(xyz_ecm)
-                radii_ecm = read_radii(data=dat_content, group_index=2)
-                r_ecm = calc_r(xyz_ecm)
-                r_ecm_binned, phi_ecm, _, _ = calc_phi(r_ecm, radii_ecm)
-
-                # MECHANICS TO BE ADDED
-
-            # Add found results
-            add_result(target=analysis_result_dict, tag="dir", item=output_dir)
-            add_result(target=analysis_result_dict, tag=".data dir", item=dat_dir)
-            add_result(target=analysis_result_dict, tag="time", item=time_index)
-
-            if type_analysis == "plane":
-                add_result(target=analysis_result_dict, tag="average velocity", item=avg_vel)
-            else:
-                add_result(target=analysis_result_dict, tag="cell count", item=cell_count)
-                add_result(target=analysis_result_dict, tag="ECM count", item=ecm_count)
-                add_result(target=analysis_result_dict, tag="radius of gyration", item=r_gyration_cells)
-
-                add_result(target=analysis_result_dict, tag="r cells", item=r_cells_binned.tolist())
-                add_result(target=analysis_result_dict, tag="phi cells", item=phi_cells.tolist())
-                add_result(target=analysis_result_dict, tag="radius of core", item=r_cells_core)
-                add_result(target=analysis_result_dict, tag="radius of invasion", item=r_cell_invasion)
-
-                add_result(target=analysis_result_dict, tag="r ECM", item=r_ecm_binned.tolist())
-                add_result(target=analysis_result_dict, tag="phi ECM", item=phi_ecm.tolist())
-
-                add_vars(target=analysis_result_dict, var_list=var_list, vars_select=vars_select)
-            if dat_iter == dat_iter_debug: break
-        if idx == idx_iter_debug: break
-
-    # *****************************
-    # *     Save measurements     *
-    # *****************************
+
+def save_session_results(res_root_dir, type_analysis, analysis_result_dict, msd_dict, dt):
+    """
+    Saves the merged results of all runs of a session as measurements.csv (and tumoroid_msd.csv), each together with
+    its binary results store.
+    """
     if type_analysis == "plane":
         msd_df = dict2dataframe(measurement_dict=msd_dict)
         dataframe2csv(res_root_dir=res_root_dir, df=msd_df, csv_filename="measurements.csv")
+        dataframe2store(res_root_dir=res_root_dir, df=msd_df, csv_filename="measurements.csv")
     else:
         analysis_result_df = dict2dataframe(measurement_dict=analysis_result_dict)
         analysis_result_df["time"] = (analysis_result_df["time"] - min(analysis_result_df["time"].values)) * dt
         dataframe2csv(res_root_dir=res_root_dir, df=analysis_result_df, csv_filename="measurements.csv")
+        dataframe2store(res_root_dir=res_root_dir, df=analysis_result_df, csv_filename="measurements.csv")
         msd_df = dict2dataframe(measurement_dict=msd_dict)
         dataframe2csv(res_root_dir=res_root_dir, df=msd_df, csv_filename="tumoroid_msd.csv")
+        dataframe2store(res_root_dir=res_root_dir, df=msd_df, csv_filename="tumoroid_msd.csv")
 
     print_log(f"Saved analysis results to {res_root_dir}!")
 
 
-def visualise_folder(session_folder, type_analysis, result_folder, vars_select, dt, freq, dpi, show):
+def folder_plot_jobs(session_folder, type_analysis, result_folder, vars_select, dt, freq, dpi, show):
     """
-    DOCSTRING
+    Lists all plots of a session as plot jobs [plot function, keyword arguments] (see visualisation.run_plot_jobs).
+    The results are grouped once per sweep level, instead of selecting each group separately.
     """
     session_label = os.path.join(result_folder, session_folder)
     analysis_output_dir = system_paths["output_analysis_dir"]
     res_root_dir = os.path.join(analysis_output_dir, result_folder, session_folder)
-    result_df = import_resultdf(res_root_dir=res_root_dir, name="measurements.csv")
-    experimental_msd_df = import_resultdf(res_root_dir=res_root_dir, name="tumoroid_msd.csv")
+    # Only the plotted columns are loaded (all for the plane analysis, which has a different naming convention)
+    columns, msd_columns = None, None
+    if type_analysis != "plane":
+        sweep_columns = ["phiecm", "divcell", "v0", "kce"]
+        columns = ["time", "r cells", "phi cells", "r ECM", "phi ECM", "radius of core", "radius of invasion",
+                   "cell count", "ECM count"] + sweep_columns
+        msd_columns = ["lag time", "MSD", "MSD/t", "MSD error"] + sweep_columns
+    result_df = import_resultdf(res_root_dir=res_root_dir, name="measurements.csv", columns=columns)
+    experimental_msd_df = import_resultdf(res_root_dir=res_root_dir, name="tumoroid_msd.csv", columns=msd_columns)
     try:
         print_log(f"Imported data with keys {list(result_df.keys())}")
         if experimental_msd_df is not None:
             print_log(f"Imported data with keys {list(experimental_msd_df.keys())}")
     except:
         print_log(f"No data found, run analysis first...")
-        return
+        return []
+    jobs = []
     if type_analysis == "plane":
         # MSD vs. time grouped by group_key
         group_key = "rotational diffusion Dr"
@@ -194,16 +286,15 @@ def visualise_folder(session_folder, type_analysis, result_folder, vars_select,
             color_key = "v0"
 
         color_range = list(np.unique(result_df[color_key]))
-        for group_val in np.unique(result_df[group_key].values):
-            msd_dr = result_df.groupby(group_key).get_group(group_val)
+        for group_val, msd_dr in result_df.groupby(group_key):
             print_log(f"{group_key}: {group_val}")
-            plot_msd(session=session_label, data=msd_dr, x="lag time", y="MSD", hue=color_key,
-                     show=show, dpi=dpi, extra_label=f" {group_short}={group_val}", log_offsets=[-2, -2],
-                     t_offset=0.1, error="MSD error", color_range=color_range)
-            plot_msd(session=session_label, data=msd_dr, x="lag time", y="MSD/t", hue=color_key,
-                     show=show, dpi=dpi, extra_label=f" {group_short}={group_val}", log_offsets=[-1, -1],
-                     t_offset=0.1, color_range=color_range)
-
+            jobs.append([plot_msd, dict(session=session_label, data=msd_dr, x="lag time", y="MSD", hue=color_key,
+                                        show=show, dpi=dpi, extra_label=f" {group_short}={group_val}",
+                                        log_offsets=[-2, -2], t_offset=0.1, error="MSD error",
+                                        color_range=color_range)])
+            jobs.append([plot_msd, dict(session=session_label, data=msd_dr, x="lag time", y="MSD/t", hue=color_key,
+                                        show=show, dpi=dpi, extra_label=f" {group_short}={group_val}",
+                                        log_offsets=[-1, -1], t_offset=0.1, color_range=color_range)])
 
     else:
         plotkeys_profile = {  # X, Y, COLOR
@@ -230,71 +321,48 @@ def visualise_folder(session_folder, type_analysis, result_folder, vars_select,
         v4val = np.unique(result_df[v4key])[0]
         print_log(f"Sweep parameters: {v1key, v2key, v3key}")
 
-        for v1 in np.unique(result_df[v1key]):
-            params_label_1v = f" {v4key}-{v4val}_{v1key}-{v1}"
-            res_sel_1v = result_df.groupby(v1key).get_group(v1)
+        # Each sweep level is grouped once: {(v1, v2): results} and {(v1, v2, v3): results}
+        msd_groups = dict(list(experimental_msd_df.groupby([v1key, v2key])))
+        res_groups_3v = {}
+        for (v1, v2, v3), res_sel_3v in result_df.groupby([v1key, v2key, v3key]):
+            res_groups_3v.setdefault((v1, v2), []).append([v3, res_sel_3v])
 
-            for v2 in np.unique(result_df[v2key]):
-                params_label_2v = f" {v4key}-{v4val}_{v1key}-{v1}_{v2key}-{v2}"
-                res_sel_2v = res_sel_1v.groupby(v2key).get_group(v2)
-                experimental_msd_set = experimental_msd_df.groupby(v1key).get_group(v1).groupby(v2key).get_group(v2)
+        for (v1, v2), res_sel_2v in result_df.groupby([v1key, v2key]):
+            params_label_2v = f" {v4key}-{v4val}_{v1key}-{v1}_{v2key}-{v2}"
+            if (v1, v2) in msd_groups:
+                experimental_msd_set = msd_groups[(v1, v2)]
                 color_range = list(np.unique(experimental_msd_set[v3key]))
-
-                plot_msd(session=session_label, data=experimental_msd_set, x="lag time", y="MSD", hue=v3key,
-                         show=show, dpi=dpi, extra_label=params_label_2v, log_offsets=[-2, -2], t_offset=freq * dt,
-                         error="MSD error", color_range=color_range)
-                plot_msd(session=session_label, data=experimental_msd_set, x="lag time", y="MSD/t", hue=v3key,
-                         show=show, dpi=dpi, extra_label=params_label_2v, log_offsets=[-1, -1], t_offset=freq * dt,
-                         color_range=color_range)
-
-                for plotkey in plotkeys_line:
-                    X, Y = plotkeys_line[plotkey]
-                    plot_lineplot(session=session_label, data=res_sel_2v, x=X, y=Y, hue=v3key, style=v2key, show=show,
-                                  dpi=dpi, extra_label=params_label_2v)
-
-                for v3 in np.unique(result_df[v3key]):
-                    params_label_3v = f" {v4key}-{v4val}_{v1key}-{v1}_{v2key}-{v2}_{v3key}-{v3}"
-                    res_sel_3v = res_sel_2v.groupby(v3key).get_group(v3)
-                    for plotkey in plotkeys_profile:
-                        X, Y, HUE = plotkeys_profile[plotkey]
-                        plot_profile(session=session_label, data=res_sel_3v, x=X, y=Y, hue=HUE, show=show, dpi=dpi,
-                                     extra_label=params_label_3v, varlabels=vars_select)
-
-
-def pool_task(args, session_folder, result_folder, vars_select, root):
-    """
-    Executes core pool tasks
-    """
-    analyse = args.analyse
-    visualise = args.visualise
-    dpi = args.dpi
-    debug = args.debug
-    dt = args.dt
-    freq = args.freq
-    show = args.show
-    type_analysis = args.type_analysis
-    dat_iter_debug = args.dat_iter_debug
-    idx_iter_debug = args.idx_iter_debug
-    if analyse:
-        analyse_folder(session_folder, type_analysis, root, vars_select, result_folder, dt, freq, debug, dat_iter_debug,
-                       idx_iter_debug)
-    if visualise:
-        visualise_folder(session_folder, type_analysis, result_folder, vars_select, dt, freq, dpi, show)
-
-
-def analyse_root_subfolders(folders_of_interests, args, vars_select):
+                jobs.append([plot_msd, dict(session=session_label, data=experimental_msd_set, x="lag time", y="MSD",
+                                            hue=v3key, show=show, dpi=dpi, extra_label=params_label_2v,
+                                            log_offsets=[-2, -2], t_offset=freq * dt, error="MSD error",
+                                            color_range=color_range)])
+                jobs.append([plot_msd, dict(session=session_label, data=experimental_msd_set, x="lag time",
+                                            y="MSD/t", hue=v3key, show=show, dpi=dpi, extra_label=params_label_2v,
+                                            log_offsets=[-1, -1], t_offset=freq * dt, color_range=color_range)])
+
+            for plotkey in plotkeys_line:
+                X, Y = plotkeys_line[plotkey]
+                jobs.append([plot_lineplot, dict(session=session_label, data=res_sel_2v, x=X, y=Y, hue=v3key,
+                                                 style=v2key, show=show, dpi=dpi, extra_label=params_label_2v)])
+
+            for v3, res_sel_3v in res_groups_3v[(v1, v2)]:
+                params_label_3v = f" {v4key}-{v4val}_{v1key}-{v1}_{v2key}-{v2}_{v3key}-{v3}"
+                for plotkey in plotkeys_profile:
+                    X, Y, HUE = plotkeys_profile[plotkey]
+                    jobs.append([plot_profile, dict(session=session_label, data=res_sel_3v, x=X, y=Y, hue=HUE,
+                                                    show=show, dpi=dpi, extra_label=params_label_3v,
+                                                    varlabels=vars_select)])
+    return jobs
+
+
+def find_sessions(folders_of_interests, args):
     """
-    Finds all paths within a given root folder, and performs analysis for a dict of parameters and resolution dpi.
+    Lists all sessions as [result_folder, root, session_folder, freq] for a list of result folders.
+    The sampling frequency is overridden by a "freq-..." label in the session name (if present).
     """
-    analyse = args.analyse
-    visualise = args.visualise
-    num_cores = args.Ncores
-
-    processes = []
-    pool = Pool(processes=num_cores)
-
+    sessions = []
     for result_folder in folders_of_interests:
-        if not analyse and visualise:
+        if not args.analyse and args.visualise:
             analysis_output_dir = system_paths["output_analysis_dir"]
             root = os.path.join(analysis_output_dir, result_folder)
         else:
@@ -303,26 +371,97 @@ def analyse_root_subfolders(folders_of_interests, args, vars_select):
         print_log(f"|- Searching {root} -|")
 
         ossearch = sorted(os.listdir(root))
-        session_root = []
         for i, folder in enumerate(ossearch):
             if os.path.isdir(os.path.join(root, folder)):
-                session_root.append(folder)
+                freq = args.freq
+                for session_var in folder.split("_"):
+                    if "freq" in session_var:
+                        freq = float(folder.split("_")[-1].split("-")[-1])
+                sessions.append([result_folder, root, folder, freq])
+    return sessions
 
-        for session_folder in session_root:
-            print_log(f"- {session_folder} -")
-            session_vars = session_folder.split("_")
-            for i in session_vars:
-                if "freq" in i:
-                    freq_override = float(session_vars[-1].split("-")[-1])
-                    args.freq = freq_override
 
-            processes.append(
-                pool.apply_async(func=pool_task, args=(args, session_folder, result_folder, vars_select, root)))
+def analyse_root_subfolders(folders_of_interests, args, vars_select):
+    """
+    Finds all paths within a given root folder, and performs analysis for a dict of parameters and resolution dpi.
+    All runs of all sessions are analysed in parallel, with at most 2 x Ncores runs queued at once. The run results
+    are gathered here and saved per session as soon as all runs of that session are done.
+    """
+    analyse = args.analyse
+    visualise = args.visualise
+    num_cores = args.Ncores
+    max_in_flight = 2 * num_cores
 
-            visualise_result_tree(path=system_paths["output_figures_dir"], tree_type="analysis", show_subfolders=True)
+    sessions = find_sessions(folders_of_interests=folders_of_interests, args=args)
 
-    for p in processes:
-        p.get()
+    if analyse:
+        pool = Pool(processes=num_cores)
+        # Run level tasks: [session index, run index, folder path, cache folder]
+        run_tasks = []
+        session_runs = []
+        for session_idx, (result_folder, root, session_folder, freq) in enumerate(sessions):
+            print_log(f"- {session_folder} -")
+            run_folders = list_run_folders(root=root, session_folder=session_folder)
+            if args.idx_iter_debug is not None:
+                run_folders = run_folders[:args.idx_iter_debug + 1]
+            print_log(f"-- Found {len(run_folders)} folders")
+            session_runs.append([None] * len(run_folders))
+            for run_idx, output_dir in enumerate(run_folders):
+                run_tasks.append([session_idx, run_idx, os.path.join(root, session_folder, output_dir),
+                                  os.path.join(system_paths["output_analysis_dir"], result_folder, session_folder,
+                                               "runs", output_dir)])
+        print_log(f"Looking for folder vars {list(vars_select.keys())}...")
+        print_log(f"-- Analysing {len(run_tasks)} folders on {num_cores} cores !")
+
+        def save_session(session_idx):
+            result_folder, root, session_folder, freq = sessions[session_idx]
+            analysis_result_dict = {}
+            msd_dict = {}
+            for run_results in session_runs[session_idx]:
+                if run_results is not None:
+                    merge_results(target=analysis_result_dict, source=run_results[0])
+                    merge_results(target=msd_dict, source=run_results[1])
+            session_runs[session_idx] = None
+            res_root_dir = os.path.join(system_paths["output_analysis_dir"], result_folder, session_folder)
+            save_session_results(res_root_dir=res_root_dir, type_analysis=args.type_analysis,
+                                 analysis_result_dict=analysis_result_dict, msd_dict=msd_dict, dt=args.dt)
+
+        runs_left = [len(runs) for runs in session_runs]
+        for session_idx in range(len(sessions)):
+            if runs_left[session_idx] == 0:
+                save_session(session_idx)
+
+        runs_done = [0]
+
+        def collect(task):
+            session_idx, run_idx, process = task
+            session_runs[session_idx][run_idx] = process.get()
+            print_progressbar(idx=runs_done[0], idxmax=len(run_tasks))
+            runs_done[0] += 1
+            runs_left[session_idx] -= 1
+            if runs_left[session_idx] == 0:
+                save_session(session_idx)
+
+        in_flight = deque()
+        for session_idx, run_idx, folder_path, cache_dir in run_tasks:
+            if len(in_flight) >= max_in_flight:
+                collect(in_flight.popleft())
+            freq = sessions[session_idx][3]
+            process = pool.apply_async(func=analyse_run,
+                                       args=(folder_path, args.type_analysis, vars_select, args.dt, freq, args.debug,
+                                             args.dat_iter_debug, args.msd_log, cache_dir))
+            in_flight.append([session_idx, run_idx, process])
+        while len(in_flight) > 0:
+            collect(in_flight.popleft())
+
+        pool.close()
+        pool.join()
+        visualise_result_tree(path=system_paths["output_figures_dir"], tree_type="analysis", show_subfolders=True)
 
-    pool.close()
-    pool.join()
+    if visualise:
+        # The plots of all sessions are collected first and then plotted on all cores
+        jobs = []
+        for result_folder, root, session_folder, freq in sessions:
+            jobs.extend(folder_plot_jobs(session_folder, args.type_analysis, result_folder, vars_select, args.dt, freq,
+                                         args.dpi, args.show))
+        run_plot_jobs(jobs, num_cores=num_cores, show=args.show)
@@ -6,7 +6,7 @@ Author: Konstantinos Andreadis
 
 import pandas as pd
 import numpy as np
-import os, json
+import os, json, re, shutil
 from scripts.communication_handler import print_log
 import ast
 
@@ -35,6 +35,31 @@ def read_params_dict(path):
     return params
 
 
+def save_run_cache(cache_dir, cache):
+    """
+    Save the cached analysis results of a single run as json file, replaced at once so it is never half written.
+    """
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_tmp = os.path.join(cache_dir, f"cache.json.{os.getpid()}")
+        with open(cache_tmp, "w") as jsonfile:
+            json.dump(cache, jsonfile, default=lambda item: item.tolist() if hasattr(item, "tolist") else str(item))
+        os.replace(cache_tmp, os.path.join(cache_dir, "cache.json"))
+    except OSError:
+        print_log(f"Could not save analysis cache to {cache_dir}...")
+
+
+def read_run_cache(cache_dir):
+    """
+    Read the cached analysis results of a single run, None if not available.
+    """
+    try:
+        with open(os.path.join(cache_dir, "cache.json"), "r") as jsonfile:
+            return json.load(jsonfile)
+    except (OSError, ValueError):
+        return None
+
+
 def combine_datasets(input_dir, output_dir):
     """
     Combine panda dataframes into output dataframe.
@@ -44,48 +69,114 @@ def combine_datasets(input_dir, output_dir):
     print_log(f"Combined {len(input_dir)} dataframes into one in {output_dir} !")
 
 
+def read_conf(path):
+    """
+    Read a SAMoS configuration file into a list of [command, name, options] entries, e.g. the line
+    "pair_param soft_attractive { type_1 = 1; type_2 = 2; k=0.6 }" gives
+    ["pair_param", "soft_attractive", {"type_1": 1.0, "type_2": 2.0, "k": 0.6}]. Options without value are True.
+    """
+    entries = []
+    with open(path, "r") as conf_file:
+        for line in conf_file:
+            line = line.split("#")[0].strip()
+            match = re.match(r"(\w+)\s*(\w*)\s*\{(.*)\}", line)
+            if match is None:
+                continue
+            command, name, body = match.groups()
+            options = {}
+            for option in body.split(";"):
+                if option.strip() == "":
+                    continue
+                key, _, value = option.partition("=")
+                value = value.strip()
+                try:
+                    options[key.strip()] = float(value) if value != "" else True
+                except ValueError:
+                    options[key.strip()] = value
+            entries.append([command, name, options])
+    return entries
+
+
+# Columns written by "dump output { type=full; ... header }", used when a .dat file has no header line.
+samos_dat_columns = ["id", "type", "flag", "radius", "x", "y", "z", "vx", "vy", "vz", "nx", "ny", "nz"]
+samos_int_columns = ["id", "type", "flag"]
+# Prefixes of the header line of a .dat file: "header" dumps start with "#", "keys" dumps (plane.conf) with "keys:"
+dat_header_prefixes = ["#", "keys:"]
+
+
 def read_dat(path):
     """
-    Read a .dat file and shift its columns to properly import data as dataFrame.
+    Read a SAMoS .dat dump into a dict of contiguous column arrays (e.g. "x", "radius", "type").
+    The header line ("#" or "keys:", see dat_header_prefixes) names the columns, a file without header line must have
+    the columns of samos_dat_columns. A ValueError is raised if the column count differs from the header.
+    "type index" maps each particle type to its row indices.
     """
-    data = pd.read_csv(path, header=0, sep='\s+')
-    colshift = {}
-    temp = data.columns
-    for u in range(len(temp) - 1):
-        colshift[temp[u]] = temp[u + 1]
-    data.rename(columns={temp[len(temp) - 1]: 'none'}, inplace=True)
-    data.rename(columns=colshift, inplace=True, errors="raise")
+    with open(path, "r") as dat_file:
+        header = dat_file.readline()
+    columns = samos_dat_columns
+    skiprows = 0
+    for prefix in dat_header_prefixes:
+        if header.startswith(prefix):
+            columns = header[len(prefix):].split()
+            skiprows = 1
+            break
+    try:
+        values = pd.read_csv(path, sep=r"\s+", header=None, skiprows=skiprows, dtype=np.float64,
+                             engine="c").to_numpy()
+    except pd.errors.EmptyDataError:
+        values = np.empty((0, len(columns)))
+    if values.shape[1] != len(columns):
+        raise ValueError(f"{path} has {values.shape[1]} columns, expected {len(columns)} ({' '.join(columns)})")
+    data = {}
+    for col_idx, column in enumerate(columns):
+        if column in samos_int_columns:
+            data[column] = values[:, col_idx].astype(np.int64)
+        else:
+            data[column] = np.ascontiguousarray(values[:, col_idx])
+    data["type index"] = {int(group_index): np.flatnonzero(data["type"] == group_index) for group_index in
+                          np.unique(data["type"])}
     return data
 
 
+def read_time_index(path):
+    """
+    Extract the SAMoS time step from a .dat file name (e.g. output_0000001000.dat).
+    """
+    return int(os.path.splitext(os.path.basename(path))[0].split("_")[-1])
+
+
+def stream_frames(folder_path, dat_files, max_iter=None):
+    """
+    Generator that reads each .dat file of a SAMoS output folder exactly once, yielding (file name, time step, data).
+    Only the current frame is kept in memory, iteration stops after index max_iter (if given).
+    """
+    for dat_iter, dat_dir in enumerate(dat_files):
+        dat_file_dir = os.path.join(folder_path, dat_dir)
+        yield dat_dir, read_time_index(path=dat_file_dir), read_dat(path=dat_file_dir)
+        if dat_iter == max_iter: break
+
+
 def read_xyz(data, group_index):
     """
     For a given cell group, retrieve all xyz cell positions.
     """
-    data = data.groupby("type").get_group(group_index)
-    xcoords = data["x"].to_numpy()
-    ycoords = data["y"].to_numpy()
-    zcoords = data["z"].to_numpy()
-    return np.column_stack([xcoords, ycoords, zcoords])
+    rows = data["type index"][group_index]
+    return np.column_stack([data["x"][rows], data["y"][rows], data["z"][rows]])
 
 
 def read_vel(data, group_index):
     """
     For a given cell group, retrieve all xyz velocity components.
     """
-    data = data.groupby("type").get_group(group_index)
-    velx = data["vx"].to_numpy()
-    vely = data["vy"].to_numpy()
-    velz = data["vz"].to_numpy()
-    return np.column_stack([velx, vely, velz])
+    rows = data["type index"][group_index]
+    return np.column_stack([data["vx"][rows], data["vy"][rows], data["vz"][rows]])
 
 
 def read_radii(data, group_index):
     """
-    For a given cell group, retrieve all xyz cell positions.
+    For a given cell group, retrieve all cell radii.
     """
-    data = data.groupby("type").get_group(group_index)
-    return data["radius"].to_numpy()
+    return data["radius"][data["type index"][group_index]]
 
 
 def add_result(target, tag, item):
@@ -113,12 +204,63 @@ def add_vars(target, var_list, vars_select):
                 add_result(target=target, tag=varsel, item=var_val)
 
 
-def import_resultdf(res_root_dir, name):
+def result_store_dir(res_root_dir, name):
+    """
+    Folder of the binary results store that belongs to a result csv file, e.g. measurements.csv -> measurements.results
+    """
+    return os.path.join(res_root_dir, f"{os.path.splitext(name)[0]}.results")
+
+
+def load_result_store(res_root_dir, name, columns=None, filters=None):
     """
-    Import a result dataframe
+    Load a result dataframe from its binary results store (see dataframe2store). Only the given columns are read
+    (all if None, requested columns that do not exist are skipped) and only the rows matching the filters, a dict of
+    {column: value or list of values}. Profile columns are returned as numpy arrays per row.
     """
+    store_dir = result_store_dir(res_root_dir, name)
+    with open(os.path.join(store_dir, "index.json"), "r") as jsonfile:
+        index = json.load(jsonfile)
+
+    def column_path(column, part=None):
+        column_idx = list(index["columns"].keys()).index(column)
+        return os.path.join(store_dir, f"{column_idx}.npy" if part is None else f"{column_idx}.{part}.npy")
+
+    rows = np.ones(index["rows"], dtype=bool)
+    if filters is not None:
+        for column, values in filters.items():
+            rows &= np.isin(np.load(column_path(column), mmap_mode="r"), values)
+    row_idx = np.flatnonzero(rows)
+
+    if columns is None:
+        columns = list(index["columns"].keys())
+    result_df = {}
+    for column in columns:
+        if column not in index["columns"]:
+            continue
+        if index["columns"][column] == "ragged":
+            values = np.load(column_path(column, "values"), mmap_mode="r")
+            offsets = np.load(column_path(column, "offsets"))
+            result_df[column] = [np.array(values[offsets[i]:offsets[i + 1]]) for i in row_idx]
+        else:
+            result_df[column] = np.load(column_path(column), mmap_mode="r")[row_idx]
+    return pd.DataFrame(result_df)
+
+
+def import_resultdf(res_root_dir, name, columns=None, filters=None):
+    """
+    Import a result dataframe, from the binary results store if available and otherwise from the csv file.
+    Optionally only the given columns and the rows matching the filters ({column: value or list of values}) are kept.
+    """
+    try:
+        return load_result_store(res_root_dir, name, columns=columns, filters=filters)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    usecols = None
+    if columns is not None:
+        usecols = lambda key: key in columns or key in (filters or {})
     try:
-        result_df = pd.read_csv(os.path.join(res_root_dir, name))
+        result_df = pd.read_csv(os.path.join(res_root_dir, name), usecols=usecols)
     except:
         print_log("Not yet processed, run -analysis first!")
         return None
@@ -129,6 +271,12 @@ def import_resultdf(res_root_dir, name):
                 result_df[key] = result_df[key].apply(ast.literal_eval)
         except:
             pass
+    if filters is not None:
+        for column, values in filters.items():
+            result_df = result_df[np.isin(result_df[column].values, values)]
+        result_df = result_df.reset_index(drop=True)
+        if columns is not None:
+            result_df = result_df[[key for key in result_df.keys() if key in columns]]
     return result_df
 
 
@@ -164,3 +312,41 @@ def dataframe2csv(res_root_dir, df, csv_filename):
         pass
 
     df.to_csv(os.path.join(res_root_dir, csv_filename), index=False)
+
+
+def dataframe2store(res_root_dir, df, csv_filename):
+    """
+    Saves a dataframe as binary results store next to its csv file: a folder with one .npy file per column and an
+    index.json of the column names and kinds. Columns of lists (profiles) are stored ragged, as the concatenated values
+    and the row offsets, so they can be loaded without parsing.
+    """
+    store_dir = result_store_dir(res_root_dir, csv_filename)
+    build_dir = f"{store_dir}.build-{os.getpid()}"
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+
+    index = {"rows": len(df), "columns": {}}
+    for column_idx, column in enumerate(df.keys()):
+        values = df[column].values
+        path = os.path.join(build_dir, f"{column_idx}")
+        if values.dtype == object and len(values) > 0 and all(
+                isinstance(item, (list, tuple, np.ndarray)) for item in values):
+            lengths = np.array([len(item) for item in values], dtype=np.int64)
+            np.save(f"{path}.values.npy", np.concatenate([np.asarray(item, dtype=np.float64) for item in values]))
+            np.save(f"{path}.offsets.npy", np.concatenate([[0], np.cumsum(lengths)]))
+            index["columns"][column] = "ragged"
+            continue
+        if values.dtype == object:
+            try:
+                values = pd.to_numeric(df[column]).values
+            except (ValueError, TypeError):
+                values = values.astype(str)
+            if values.dtype == object:
+                values = values.astype(str)
+        np.save(f"{path}.npy", values)
+        index["columns"][column] = str(values.dtype)
+    with open(os.path.join(build_dir, "index.json"), "w") as jsonfile:
+        json.dump(index, jsonfile, indent=4)
+
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.replace(build_dir, store_dir)
@@ -7,101 +7,205 @@ Author: Konstantinos Andreadis
 *  New analysis code that calculates force, stress, traction and pressure
 *  for each particle i and its neighbours j per SAMoS simulation time step
 *  based on equations and SAMoSA from Silke.
-* 
+*
+*  All functions work on a whole frame at once: the neighbour pairs (i, j)
+*  of a frame are stored as a numpy matrix Mx2 and pair quantities are
+*  summed onto the particles with np.bincount.
+*  Convention: drvec_ij = r_j - r_i (minimum image) and forcevec_ij is the
+*  force on particle i due to j, particle j feels -forcevec_ij.
+*
 *****************************************************************************
 """
 
 import numpy as np
+from scipy.spatial import cKDTree
+from scripts.data_handler import read_conf
 
 
-def find_neighbours(particle_i, all_particles, params):
+def read_mechanics_params(conf_path):
+    """
+    Reads the parameters needed for the mechanics analysis from a (run) configuration.conf file:
+    periodic box size "box", neighbour list cutoff "rcut" and padding "pad", the soft_attractive potential ("re_fact",
+    stiffness "k" per type pair) and the abp_actreact potential (interaction range "r_int", activity "p" per type).
+    A KeyError is raised if the box or the neighbour list is missing, a ValueError if a value is not a number (e.g. an
+    unsubstituted "@L"), so that such configurations are skipped by the mechanics analysis.
     """
-    For a particle i inside all particles this function finds all neighbouring particles j
-    given the dict params.
+    params = {"k": {}, "k_default": 1.0, "re_fact": 1.0, "p": {}, "p_default": 0.0, "r_int": 1.0,
+              "use_particle_radii": False}
+    for command, name, options in read_conf(conf_path):
+        if command == "box":
+            params["box"] = np.array([options["lx"], options["ly"], options["lz"]], dtype=float)
+        elif command == "nlist":
+            params["rcut"] = options["rcut"]
+            params["pad"] = options.get("pad", 0.0)
+        elif command == "pair_potential" and name == "soft_attractive":
+            params["re_fact"] = options.get("re_fact", params["re_fact"])
+            params["k_default"] = options.get("k", params["k_default"])
+            params["use_particle_radii"] = options.get("use_particle_radii", False)
+        elif command == "pair_param" and name == "soft_attractive":
+            type_1, type_2 = int(options["type_1"]), int(options["type_2"])
+            params["k"][(type_1, type_2)] = options["k"]
+            params["k"][(type_2, type_1)] = options["k"]
+        elif command == "pair_potential" and name == "abp_actreact":
+            params["p_default"] = options.get("p", params["p_default"])
+            params["r_int"] = options.get("r_int", params["r_int"])
+        elif command == "pair_type_param" and name == "abp_actreact":
+            params["p"][int(options["type"])] = options["p"]
+
+    for key in ["box", "rcut"]:
+        if key not in params:
+            raise KeyError(f"{key} missing in {conf_path}")
+    values = [params[key] for key in ["rcut", "pad", "re_fact", "k_default", "p_default", "r_int"]]
+    values += list(params["box"]) + list(params["k"].values()) + list(params["p"].values())
+    for value in values:
+        # read_conf gives floats, anything else (text or an option without value) is not a valid number
+        if not isinstance(value, (float, np.floating)) or not np.isfinite(value):
+            raise ValueError(f"Non-numeric mechanics parameter {value!r} in {conf_path}")
+    return params
+
+
+def find_neighbours(xyz, params):
     """
-    particle_j = None
-    return particle_j
+    For all particles of a frame (xyz positions given as numpy matrix Nx3) this function finds all neighbouring pairs
+    (i, j), i < j, within the SAMoS neighbour list distance rcut + pad given the dict params (see
+    read_mechanics_params). A periodic KD-tree is used, so the search is done for the whole frame at once.
+    Returns a numpy matrix Mx2 of particle indices.
+    """
+    box = params["box"]
+    # SAMoS coordinates lie within [-L/2, L/2), the periodic KD-tree requires [0, L)
+    positions = np.mod(xyz + box / 2, box)
+    positions[positions >= box] = 0.0
+    tree = cKDTree(positions, boxsize=box)
+    pairs = tree.query_pairs(r=params["rcut"] + params["pad"], output_type="ndarray")
+    return pairs
 
 
-def calc_drvec(particle_i, particle_j, params):
+def sum_over_pairs(pairs, values_ij, values_ji, particle_count):
     """
-    Calculates the vector between particles i and j
+    Sums pair quantities onto the particles: values_ij (length M, any trailing shape) is added to particle i and
+    values_ji to particle j of each pair.
     """
-    drvec_ij = np.array([0.0, 0.0, 0.0])
-    drmag_ij = np.linalg.norm(drvec_ij)
+    trailing_shape = values_ij.shape[1:]
+    values_ij = values_ij.reshape(len(pairs), -1)
+    values_ji = values_ji.reshape(len(pairs), -1)
+    total = np.empty((particle_count, values_ij.shape[1]))
+    for col in range(values_ij.shape[1]):
+        total[:, col] = np.bincount(pairs[:, 0], weights=values_ij[:, col], minlength=particle_count) + np.bincount(
+            pairs[:, 1], weights=values_ji[:, col], minlength=particle_count)
+    return total.reshape((particle_count,) + trailing_shape)
+
+
+def calc_drvec(xyz, pairs, params):
+    """
+    Calculates the (minimum image) vectors drvec_ij = r_j - r_i and distances between all pairs of particles i and j
+    """
+    box = params["box"]
+    drvec_ij = xyz[pairs[:, 1]] - xyz[pairs[:, 0]]
+    drvec_ij -= box * np.rint(drvec_ij / box)
+    drmag_ij = np.sqrt(np.sum(np.square(drvec_ij), axis=1))
     return drvec_ij, drmag_ij
 
 
-def calc_forcevec(particle_i, particle_j, params):
+def calc_forcevec(pairs, drvec_ij, drmag_ij, radius, types, director, params):
     """
-    Calculates the passive and active force between particles i and j given dict params
+    Calculates the passive and active force on particle i due to j for all pairs given dict params.
+    Passive: SAMoS soft_attractive potential, repulsive k (a_i + a_j - r) up to re_fact (a_i + a_j), then attractive
+    decaying linearly to zero at (2 re_fact - 1)(a_i + a_j).
+    Active: abp_actreact, the propulsion p n of an active particle is transmitted equally to its z neighbours within
+    r_int (a_i + a_j), which feel the opposite (reaction) force, so that the total momentum is conserved.
     """
-    drvec_ij = calc_drvec(particle_i=particle_i, particle_j=particle_j, params=params)
-    drmag_ij = np.linalg.norm(drvec_ij)
+    type_i, type_j = types[pairs[:, 0]], types[pairs[:, 1]]
+    if params["use_particle_radii"]:
+        scale = radius[pairs[:, 0]] + radius[pairs[:, 1]]
+    else:
+        scale = np.full(len(pairs), 2.0)
+    unitvec_ij = drvec_ij / np.maximum(drmag_ij, 1e-12)[:, np.newaxis]
+
     # Passive force
-    passive_forcevec_ij = 0.0
-
-    # scale=radi+radj
-    # diff=scale-dr
-    # dscaled=diff/scale
-    # rep = [index for index, value in enumerate(dscaled) if value > -self.fact]
-    # #print "Before upshot ones: " + str(len(rep))
-    # att = [index for index, value in enumerate(dscaled) if value <= -self.fact]
-    # #print "Attractive after upshot ones: " + str(len(att))
-    # factor=np.empty((len(neighbours),))
-    # # repulsive ones
-    # factor[rep] = self.k*diff[rep]
-    # # attractive ones
-    # factor[att]=-self.k*(self.rmax*scale[att]-dr[att])
-    # Fvec=((factor/dr).transpose()*(drvec).transpose()).transpose()
+    k = np.full(len(pairs), params["k_default"])
+    for (type_1, type_2), k_val in params["k"].items():
+        k[(type_i == type_1) & (type_j == type_2)] = k_val
+    fact = params["re_fact"] - 1.0
+    rmax = 1 + 2 * fact
+    factor = np.zeros(len(pairs))
+    repulsive = drmag_ij < (1 + fact) * scale
+    attractive = ~repulsive & (drmag_ij < rmax * scale)
+    factor[repulsive] = k[repulsive] * (scale[repulsive] - drmag_ij[repulsive])
+    factor[attractive] = -k[attractive] * (rmax * scale[attractive] - drmag_ij[attractive])
+    passive_forcevec_ij = -factor[:, np.newaxis] * unitvec_ij
 
     # Active force
-    active_forcevec_ij = 0.0
+    activity = np.full(len(radius), params["p_default"])
+    for type_idx, p_val in params["p"].items():
+        activity[types == type_idx] = p_val
+    in_range = drmag_ij < params["r_int"] * scale
+    contacts = np.bincount(pairs[in_range].ravel(), minlength=len(radius))
+    propulsion = activity[:, np.newaxis] * director / np.maximum(contacts, 1)[:, np.newaxis]
+    active_forcevec_ij = np.zeros_like(drvec_ij)
+    active_forcevec_ij[in_range] = propulsion[pairs[in_range, 0]] - propulsion[pairs[in_range, 1]]
     return passive_forcevec_ij, active_forcevec_ij
 
 
-def calc_stress(particle_i, drvec_ij, forcevec_ij):
+def calc_stress(pairs, drvec_ij, forcevec_ij, particle_count):
     """
-    Calculates the passive and active stress on particle i
+    Calculates the (virial) stress tensor on each particle, sigma_i = -1/2 sum_j drvec_ij x forcevec_ij, which is
+    positive for compression. Call separately with the passive and active pair forces.
     """
-    # Passive Stress
-    passive_stress_i = 0.0
-    # Active Stress
-    active_stress_i = 0.0
-    return passive_stress_i, active_stress_i
+    pair_stress = -0.5 * drvec_ij[:, :, np.newaxis] * forcevec_ij[:, np.newaxis, :]
+    # Both drvec and the force change sign for particle j, so it receives the same contribution
+    return sum_over_pairs(pairs, pair_stress, pair_stress, particle_count)
 
 
-def calc_traction(particle_i, passive_stress_i, active_stress_i):
+def calc_traction(stress, surface_normalvec):
     """
-    Calculates the passive and active traction on particle i 
+    Calculates the traction sigma_i . n_i on each particle for a stress tensor (Nx3x3) and unit normals (Nx3)
     """
-    surface_normalvec_i = None
-    # Passive Traction
-    passive_traction_i = 0.0
-    # Active Traction
-    active_traction_i = 0.0
-    return passive_traction_i, active_traction_i
+    return np.einsum("nkl,nl->nk", stress, surface_normalvec)
 
 
-def calc_pressure(particle_i, passive_stress_i, active_stress_i):
+def calc_pressure(stress):
     """
-    Calculates the passive and active pressure on particle i 
+    Calculates the pressure (trace of the stress tensor) on each particle
     """
-    # Passive Pressure
-    passive_pressure_i = np.trace(passive_stress_i)
-    # Active Pressure
-    active_pressure_i = np.trace(active_stress_i)
-    return passive_pressure_i, active_pressure_i
+    return np.trace(stress, axis1=1, axis2=2)
 
 
-def analyse_mechanics(particle_i, params, all_particles):
+def analyse_mechanics(data, params):
     """
-    For each particle i analyse its mechanics.
+    For all particles of a frame (dict of columns, see data_handler.read_dat) analyse their mechanics.
+    Returns a dict of per particle forces (Nx3), stress tensors (Nx3x3), pressures (N) and radial tractions (Nx3).
     """
-    all_particle_j = find_neighbours(particle_i=particle_i, all_particles=all_particles, params=params)
-    for particle_j in all_particle_j:
-        drvec_ij, drmag_ij = calc_drvec(particle_i=particle_i, particle_j=particle_j, params=params)
-        # Calculate the force
-        # Calculate the stress
-        # Calculate the traction
+    xyz = np.column_stack([data["x"], data["y"], data["z"]])
+    director = np.column_stack([data["nx"], data["ny"], data["nz"]])
+    radius = np.asarray(data["radius"])
+    types = np.asarray(data["type"])
+    particle_count = len(xyz)
+
+    pairs = find_neighbours(xyz=xyz, params=params)
+    drvec_ij, drmag_ij = calc_drvec(xyz=xyz, pairs=pairs, params=params)
+    # Only pairs within reach of either potential contribute
+    scale = radius[pairs[:, 0]] + radius[pairs[:, 1]] if params["use_particle_radii"] else 2.0
+    interacting = drmag_ij < max(2 * params["re_fact"] - 1, params["r_int"]) * scale
+    pairs, drvec_ij, drmag_ij = pairs[interacting], drvec_ij[interacting], drmag_ij[interacting]
+    # Calculate the force
+    passive_forcevec_ij, active_forcevec_ij = calc_forcevec(pairs=pairs, drvec_ij=drvec_ij, drmag_ij=drmag_ij,
+                                                            radius=radius, types=types, director=director,
+                                                            params=params)
+    # Calculate the stress
+    passive_stress = calc_stress(pairs, drvec_ij, passive_forcevec_ij, particle_count)
+    active_stress = calc_stress(pairs, drvec_ij, active_forcevec_ij, particle_count)
+    # Calculate the traction, with the radial direction wrt. the C.M. of the cells as surface normal
+    cm = np.mean(xyz[types == 1], axis=0) if np.any(types == 1) else np.zeros(3)
+    radial = xyz - cm
+    radial /= np.maximum(np.sqrt(np.sum(np.square(radial), axis=1)), 1e-12)[:, np.newaxis]
+    return {
+        "passive force": sum_over_pairs(pairs, passive_forcevec_ij, -passive_forcevec_ij, particle_count),
+        "active force": sum_over_pairs(pairs, active_forcevec_ij, -active_forcevec_ij, particle_count),
+        "passive stress": passive_stress,
+        "active stress": active_stress,
         # Calculate the pressure
+        "passive pressure": calc_pressure(passive_stress),
+        "active pressure": calc_pressure(active_stress),
+        "passive traction": calc_traction(passive_stress, radial),
+        "active traction": calc_traction(active_stress, radial),
+    }
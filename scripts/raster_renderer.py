@@ -0,0 +1,91 @@
+"""
+Raster rendering of SAMoS frames: particles are drawn as discs straight into a numpy image, without matplotlib.
+!! This cannot be run independently, it is a helper script.
+Author: Konstantinos Andreadis
+*****************************************************************************
+*
+*  Orthographic view along -z onto the xy plane of the box [-L/2, L/2]^2:
+*     projection   all particles as discs of their radius, drawn back to front (ascending z)
+*     slab         only particles that reach into the slab |z| < slab/2, i.e. |z| < slab/2 + radius, as discs of
+*                  their largest cross-section within the slab (the full radius if their centre lies inside it)
+*  Each particle type is drawn as a layer, blended by its alpha over the image, higher types first so that the
+*  cells (type 1) end up on top. Discs get a darker rim to look like spheres.
+*  Colors: by type, by speed |v| (viridis) or by the in-plane director angle (hsv).
+*
+*****************************************************************************
+"""
+import numpy as np
+import cv2
+from matplotlib import colormaps
+from matplotlib.colors import to_rgb
+
+color_modes = ["type", "velocity", "director"]
+# Sub-pixel precision of the disc centres and radii (fractional bits, see cv2.circle)
+subpixel_bits = 4
+# Brightness of the rim of a disc and radius fraction of its bright centre
+rim_shade = 0.7
+centre_fraction = 0.6
+
+
+def particle_colors(data, mask, color, color_by):
+    """
+    RGB colors (N x 3, in [0, 1]) of the particles mask: the type color, the speed |v| or the director angle.
+    """
+    if color_by == "velocity":
+        speed = np.sqrt(data["vx"][mask] ** 2 + data["vy"][mask] ** 2 + data["vz"][mask] ** 2)
+        return colormaps["viridis"](speed / max(np.max(speed, initial=0.0), 1e-12))[:, :3]
+    if color_by == "director":
+        angle = np.arctan2(data["ny"][mask], data["nx"][mask])
+        return colormaps["hsv"]((angle + np.pi) / (2 * np.pi))[:, :3]
+    return np.broadcast_to(np.array(to_rgb(color)), (np.sum(mask), 3))
+
+
+def draw_discs(image, px, py, pixel_radius, colors):
+    """
+    Draws filled discs (in the given order, later ones on top) with a darker rim into a BGR image, at sub-pixel pixel
+    centres (px, py) with pixel radii pixel_radius and RGB colors in [0, 1].
+    """
+    scale = 2 ** subpixel_bits
+    centres = [tuple(centre) for centre in np.round(np.column_stack([px, py]) * scale).astype(int).tolist()]
+    radii = np.round(pixel_radius * scale).astype(int).tolist()
+    centre_radii = np.round(centre_fraction * pixel_radius * scale).astype(int).tolist()
+    bgr = 255 * colors[:, ::-1]
+    rim_colors = np.round(rim_shade * bgr).tolist()
+    centre_colors = np.round(bgr).tolist()
+    for disc_idx, radius in enumerate(radii):
+        cv2.circle(image, centres[disc_idx], radius, rim_colors[disc_idx], -1, cv2.LINE_8, subpixel_bits)
+        cv2.circle(image, centres[disc_idx], centre_radii[disc_idx], centre_colors[disc_idx], -1, cv2.LINE_8,
+                   subpixel_bits)
+
+
+def render_raster(data, L, styles, image_size=500, slab=None, cut_z=False, color_by="type"):
+    """
+    Renders a frame (dict of column arrays, see data_handler.read_dat) as BGR image (image_size x image_size x 3,
+    uint8, as used by cv2) of the box of size L, see the module description. styles gives the color and alpha of each
+    drawn particle type {type: [color, alpha]}; particles with z > 0 are left out if cut_z.
+    """
+    image = np.full((image_size, image_size, 3), 255, dtype=np.uint8)
+    scale = image_size / L
+    radius = data["radius"]
+    z = data["z"]
+    visible = np.ones(len(radius), dtype=bool)
+    if cut_z:
+        visible &= z <= 0
+    if slab is not None:
+        # Distance of each particle centre to the slab, its largest cross-section within the slab is drawn
+        slab_distance = np.maximum(np.abs(z) - slab / 2, 0.0)
+        visible &= slab_distance < radius
+        radius = np.sqrt(np.maximum(radius ** 2 - slab_distance ** 2, 0.0))
+    for type_idx in sorted(styles.keys(), reverse=True):
+        color, alpha = styles[type_idx]
+        mask = visible & (data["type"] == type_idx)
+        if not np.any(mask):
+            continue
+        order = np.argsort(z[mask], kind="stable")
+        layer = image.copy()
+        draw_discs(layer, px=((data["x"][mask] + L / 2) * scale)[order],
+                   py=((L / 2 - data["y"][mask]) * scale)[order], pixel_radius=(radius[mask] * scale)[order],
+                   colors=particle_colors(data, mask, color, color_by)[order])
+        # Pixels without discs are the same in both, so only the discs are blended
+        image = cv2.addWeighted(layer, alpha, image, 1 - alpha, 0)
+    return image
@@ -3,24 +3,457 @@ Handler for all samos executions.
 !! This cannot be run independently, it is a helper script.
 Author: Konstantinos Andreadis
 """
-import os, re
+import os, re, shutil, subprocess, threading, multiprocessing, json, datetime, hashlib
 import numpy as np
 import samos_init.initialise_cells as init_cells
 import samos_init.initialise_tumoroid_ECM as init_tumoroid_ecm
 from paths_init import system_paths
 from scripts.communication_handler import print_log, visualise_result_tree, create_samos_folder_name
-from scripts.data_handler import save_dict
-import multiprocessing
+from scripts.data_handler import save_dict, read_dat, read_time_index
+from scripts.sweep_planner import plan_points, sweep_label, count_points
+from samos_init.particle_array import save_particles, load_particles, columns_to_particles
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import copy
 
+# Sweep ledger: status of each parameter point (run folder) of a session, see update_ledger
+ledger_file_name = "sweep_ledger.json"
+ledger_time_format = "%Y/%m/%d %H:%M:%S"
+# Parameters that do not change the result of a simulation, left out of its parameter hash (see params_hash)
+execution_params = ["session", "debug", "disable_samos", "digit_precision", "archive_init", "Ncores", "timeout"]
+# File extension of an archived initial configuration, see run_simulation
+archive_extensions = {"gzip": ".gz", "npy": ".npy"}
+ledger_lock = threading.Lock()
+# Locks of the initial configuration cache (see init_particles): one per cache key, created under init_cache_lock
+init_cache_lock = threading.Lock()
+init_cache_key_locks = {}
+# Comment lines that split a configuration file into its relaxation and production stage, see split_configuration
+relaxation_marker = "# === relaxation stage ==="
+production_marker = "# === production stage ==="
+# Name of the final dump of a relaxation run, one file per dumped time step ("multi"), the last one is used
+relaxed_dump_name = "relaxed"
 
-def run_simulation(params, group_folder, session, naming_conv, run_samos=True):
+
+def read_ledger(session_dir):
+    """
+    Read the sweep ledger of a session folder as dict {run folder: entry}, empty if not available.
+    """
+    try:
+        with open(os.path.join(session_dir, ledger_file_name), "r") as jsonfile:
+            return json.load(jsonfile)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_ledger(session_dir, naming_conv, **entry):
+    """
+    Updates the sweep ledger entry of a run folder, e.g. status (pending/running/done/failed), start, end and exit code.
+    The ledger is rewritten at once (temporary file + os.replace), so an interruption never leaves it half written.
+    """
+    with ledger_lock:
+        ledger = read_ledger(session_dir)
+        ledger.setdefault(naming_conv, {}).update(entry)
+        os.makedirs(session_dir, exist_ok=True)
+        ledger_tmp = os.path.join(session_dir, f"{ledger_file_name}.{os.getpid()}")
+        with open(ledger_tmp, "w") as jsonfile:
+            json.dump(ledger, jsonfile, indent=4)
+        os.replace(ledger_tmp, os.path.join(session_dir, ledger_file_name))
+
+
+def ledger_time():
+    return datetime.datetime.now().strftime(ledger_time_format)
+
+
+def params_hash(params):
+    """
+    Hash of all parameters of a simulation that determine its result (see execution_params), saved in the sweep
+    ledger, such that a run folder is only skipped as done if it was run with the same parameters, also those that are
+    not part of the folder name (e.g. kee, Nrelax, packing or seed).
+    """
+    result_params = {name: value for name, value in params.items() if name not in execution_params}
+    return hashlib.sha1(json.dumps(result_params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def estimate_cost(params):
+    """
+    Estimated (relative) runtime of a simulation: particle count x number of time steps, plus the Nrelax relaxation
+    steps unless the relaxation is shared (see shares_relaxation), since it then runs once per initial configuration.
+    The particle count of a tumoroid includes the ECM (see initialise_tumoroid_ECM.estimate_particle_count), and cell
+    division adds on average Ncell x divcell x (Nframes dt) / 2 cells over the run.
+    """
+    particle_count = int(params["Ncell"])
+    if params.get("tumoroid_ecm", False):
+        particle_count = init_tumoroid_ecm.estimate_particle_count(cell_N=params["Ncell"], cell_radius=params["rcell"],
+                                                                   ecm_phi=params["phiecm"], ecm_radius=params["recm"],
+                                                                   ecm_size=params["L"])
+    division_count = int(params["Ncell"]) * params.get("divcell", 0.0) * params["Nframes"] * params.get("dt", 0.01) / 2
+    relaxation_steps = 0 if shares_relaxation(params) else params.get("Nrelax", 0)
+    return (particle_count + division_count) * params["Nframes"] + particle_count * relaxation_steps
+
+
+def seconds_per_cost(group_dir):
+    """
+    Median runtime per unit of estimated cost of all finished simulations in the sweep ledgers of a group folder, per
+    geometry of the initial configuration (see init_geometry) as dict {geometry: seconds per cost}, empty if there are
+    none yet. The median over all geometries is given as None, for geometries without finished simulations.
+    """
+    ratios = {}
+    try:
+        sessions = os.listdir(group_dir)
+    except OSError:
+        return {}
+    for session in sessions:
+        for entry in read_ledger(os.path.join(group_dir, session)).values():
+            if entry.get("status") != "done" or not entry.get("cost") or entry.get("start") is None:
+                continue
+            start = datetime.datetime.strptime(entry["start"], ledger_time_format)
+            end = datetime.datetime.strptime(entry["end"], ledger_time_format)
+            ratio = (end - start).total_seconds() / entry["cost"]
+            ratios.setdefault(entry.get("geometry"), []).append(ratio)
+            if entry.get("geometry") is not None:
+                ratios.setdefault(None, []).append(ratio)
+    return {geometry: float(np.median(values)) for geometry, values in ratios.items()}
+
+
+def estimate_runtime(params, cost, runtime_per_cost):
+    """
+    Estimated runtime (seconds) of a simulation of estimated cost, scaled by the measured seconds per cost of its
+    geometry (see seconds_per_cost), or of all geometries if it has none yet. None without any measurement.
+    """
+    ratio = runtime_per_cost.get(init_geometry(params)[0], runtime_per_cost.get(None))
+    return None if ratio is None else ratio * cost
+
+
+class SamosSupervisor:
+    """
+    Runs up to num_cores SAMoS simulations at the same time. Each simulation is a subprocess started (and waited for) by
+    a thread of a thread pool, so no Python interpreter is forked per simulation. Running simulations are kept track of,
+    such that all of them can be cancelled at once. At most 2 x num_cores simulations are queued, submit blocks until
+    there is room, so that parameter points can be planned one by one.
+    The status of every simulation is kept in the sweep ledger of its session folder. If resume is True, simulations
+    that are done according to the ledger are skipped, so an interrupted sweep only re-runs failed or missing ones.
+    The initial particles are generated by a pool of up to num_cores processes (see generate), as the Python code of
+    the threads would be serialised by the GIL.
+    """
+
+    def __init__(self, num_cores, timeout=None, resume=True):
+        self.executor = ThreadPoolExecutor(max_workers=num_cores)
+        self.timeout = timeout
+        self.resume = resume
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.futures = []
+        self.skipped = 0
+        self.slots = threading.BoundedSemaphore(2 * num_cores)
+        # Worker processes are spawned (not forked from this multi-threaded process) once they are needed
+        self.generator = ProcessPoolExecutor(max_workers=num_cores, mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self, params, group_folder, session, naming_conv, run_samos=True, cost=None):
+        """
+        Queues a simulation, see run_simulation. Returns None if it is skipped as it is done already with the same
+        parameters (see params_hash), a run folder that is done with other parameters is run again.
+        The estimated cost (see estimate_cost) and the geometry are saved in the ledger, to calibrate the runtime of
+        later sweeps (see seconds_per_cost).
+        """
+        session_dir = os.path.join(system_paths["output_samos_dir"], group_folder, session)
+        run_hash = params_hash(params)
+        entry = read_ledger(session_dir).get(naming_conv, {})
+        if self.resume and entry.get("status") == "done":
+            # Entries of older ledgers have no parameter hash, they are trusted
+            if entry.get("params_hash", run_hash) == run_hash:
+                print_log(f"-- {naming_conv} is done already, skipping...")
+                self.skipped += 1
+                return None
+            print_log(f"!! {naming_conv} is done with other parameters, running it again...")
+        update_ledger(session_dir, naming_conv, status="pending", start=None, end=None, exit_code=None, cost=cost,
+                      geometry=init_geometry(params)[0], params_hash=run_hash)
+        self.slots.acquire()
+        future = self.executor.submit(self.run, params, group_folder, session, naming_conv, run_samos)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append([naming_conv, future])
+        return future
+
+    def run(self, params, group_folder, session, naming_conv, run_samos):
+        """
+        Runs a simulation (see run_simulation) and keeps its sweep ledger entry up to date.
+        """
+        session_dir = os.path.join(system_paths["output_samos_dir"], group_folder, session)
+        update_ledger(session_dir, naming_conv, status="running", start=ledger_time())
+        try:
+            exit_code = run_simulation(params, group_folder, session, naming_conv, run_samos, self.timeout, self)
+        except Exception:
+            update_ledger(session_dir, naming_conv, status="failed", end=ledger_time())
+            raise
+        if exit_code == 0:
+            status = "done"
+        elif exit_code is None and not run_samos:
+            # Only initialised, SAMoS still has to run
+            status = "pending"
+        else:
+            status = "failed"
+        update_ledger(session_dir, naming_conv, status=status, end=ledger_time(), exit_code=exit_code)
+        return exit_code
+
+    def generate(self, params, outfile):
+        """
+        Generates the initial particles of a simulation (see generate_particles) in a process of the generator pool.
+        """
+        self.generator.submit(generate_particles, params, outfile).result()
+
+    def register(self, process):
+        """
+        Keeps track of a started SAMoS process, it is terminated immediately if the supervisor was cancelled already.
+        """
+        with self.lock:
+            self.processes.add(process)
+            if self.cancelled.is_set():
+                process.terminate()
+
+    def unregister(self, process):
+        with self.lock:
+            self.processes.discard(process)
+
+    def cancel(self):
+        """
+        Cancels all queued simulations and terminates all running SAMoS processes.
+        """
+        self.cancelled.set()
+        for naming_conv, future in self.futures:
+            future.cancel()
+        self.generator.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            for process in self.processes:
+                process.terminate()
+        print_log(f"!! Cancelled, terminated {len(self.processes)} running simulation(s)")
+
+    def wait(self):
+        """
+        Waits for all simulations to finish and returns the names of the failed ones (error or non-zero exit code).
+        """
+        failed = []
+        for naming_conv, future in self.futures:
+            try:
+                exit_code = future.result()
+            except Exception as error:
+                print_log(f"!! {naming_conv} failed: {error}")
+                failed.append(naming_conv)
+                continue
+            if exit_code not in [0, None]:
+                failed.append(naming_conv)
+        self.executor.shutdown()
+        self.generator.shutdown()
+        if self.skipped > 0:
+            print_log(f"-- Skipped {self.skipped} simulations that were done already")
+        if len(failed) > 0:
+            print_log(f"!! {len(failed)} of {len(self.futures)} simulations failed, see samos.log in their folders")
+        return failed
+
+
+def execute_samos(configuration_dir, result_dir, timeout=None, supervisor=None):
+    """
+    Executes SAMoS for a configuration file within result_dir, with its terminal output saved to samos.log.
+    Returns the exit code (negative if killed after timeout seconds or cancelled), None if SAMoS could not be started.
+    """
+    if supervisor is not None and supervisor.cancelled.is_set():
+        return None
+    with open(os.path.join(result_dir, "samos.log"), "w") as log_file:
+        try:
+            process = subprocess.Popen([system_paths["samos_dir"], configuration_dir], cwd=result_dir,
+                                       stdout=log_file, stderr=subprocess.STDOUT)
+        except OSError:
+            print_log("Could not locate SAMoS executable...")
+            return None
+        if supervisor is not None:
+            supervisor.register(process)
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            print_log(f"!! SAMoS exceeded the timeout of {timeout} s, killing {result_dir}...")
+            process.kill()
+            process.wait()
+        finally:
+            if supervisor is not None:
+                supervisor.unregister(process)
+    if process.returncode != 0:
+        print_log(f"!! SAMoS exited with code {process.returncode}, see {os.path.join(result_dir, 'samos.log')}")
+    return process.returncode
+
+
+def init_geometry(params):
+    """
+    Type of initial configuration of a simulation and the parameters that determine it (besides seed and packing).
+    """
+    if params["plane"]:
+        return "plane", ["L", "phi", "cell_radius", "cell_radius_poly"]
+    if params["tumoroid_ecm"]:
+        return "tumoroid_ecm", ["Ncell", "rcell", "polycell", "phiecm", "recm", "polyecm", "L"]
+    return "spheroid", ["Ncell", "cell_radius", "cell_radius_poly", "track", "Ntrack"]
+
+
+def init_cache_key(params):
+    """
+    Content address of the initial configuration of a simulation: hash of its geometry parameters, seed and packing.
+    Returns the key and the dict of parameters it was made of.
+    """
+    geometry, names = init_geometry(params)
+    key_params = {"geometry": geometry, "seed": params["seed"], "packing": params.get("packing", "random")}
+    if key_params["packing"] != "random":
+        key_params["overlap"] = params.get("overlap", 0.1)
+    for name in names:
+        key_params[name] = params[name]
+    key = hashlib.sha1(json.dumps(key_params, sort_keys=True).encode()).hexdigest()[:16]
+    return key, key_params
+
+
+def generate_particles(params, outfile):
+    """
+    Generates the initial particles of a simulation (see samos_init/) and saves them to outfile.
+    The random numbers are drawn from a generator seeded with params["seed"] (unseeded if None).
+    """
+    rng = np.random.default_rng(params.get("seed"))
+    if params["plane"]:
+        collective = init_cells.Plane(L=params["L"], phi=params["phi"], cell_radius=params["cell_radius"],
+                                      poly=params["cell_radius_poly"], rng=rng, packing=params.get("packing", "random"),
+                                      overlap=params.get("overlap", 0.1))
+        init_cells.save_initial_cells(collective.particles, outfile)
+    elif params["tumoroid_ecm"]:
+        all_particles = init_tumoroid_ecm.Spheroid(cell_N=params["Ncell"], cell_radius=params["rcell"],
+                                                   cell_poly=params["polycell"],
+                                                   ecm_phi=params["phiecm"], ecm_radius=params["recm"],
+                                                   ecm_poly=params["polyecm"], ecm_size=params["L"], rng=rng,
+                                                   packing=params.get("packing", "random"),
+                                                   overlap=params.get("overlap", 0.1)).particles
+        init_tumoroid_ecm.save_initial_cells(cells_data=all_particles, outfile=outfile)
+    else:
+        collective = init_cells.Spheroid(cell_radius=params["cell_radius"], cell_count=params["Ncell"],
+                                         poly=params["cell_radius_poly"], add_tracker_cells=params["track"],
+                                         tracker_cell_count=params["Ntrack"], rng=rng,
+                                         packing=params.get("packing", "random"), overlap=params.get("overlap", 0.1))
+        init_cells.save_initial_cells(collective.particles, outfile)
+
+
+def init_cache_key_lock(key):
+    """
+    Lock of a key of the initial configuration cache, the same one for all threads.
+    """
+    with init_cache_lock:
+        return init_cache_key_locks.setdefault(key, threading.Lock())
+
+
+def init_particles(params, outfile, supervisor=None):
+    """
+    Provides the initial particles of a simulation as outfile, generated in a process of the supervisor (if given).
+    With an initial configuration cache (system_paths["init_cache_dir"]) and a seed, simulations of the same geometry,
+    seed and packing (see init_cache_key) share one generated configuration, only dynamics parameters like v0 or kce
+    differ between them.
+    Cached configurations are written at once (temporary file + os.replace), each key is generated only once.
+    """
+    generate = generate_particles if supervisor is None else supervisor.generate
+    cache_dir = system_paths.get("init_cache_dir")
+    if cache_dir is None or params.get("seed") is None:
+        generate(params, outfile)
+        return
+    key, key_params = init_cache_key(params)
+    cached_file = os.path.join(cache_dir, f"{key}.txt")
+    with init_cache_key_lock(key):
+        if os.path.isfile(cached_file):
+            print_log(f"-- Reusing initial configuration {key} ({key_params['geometry']})")
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            cached_tmp = os.path.join(cache_dir, f"{key}.{os.getpid()}.tmp")
+            generate(params, cached_tmp)
+            with open(os.path.join(cache_dir, f"{key}.json"), "w") as jsonfile:
+                json.dump(key_params, jsonfile, indent=4)
+            os.replace(cached_tmp, cached_file)
+    shutil.copy(cached_file, outfile)
+
+
+def shares_relaxation(params):
+    """
+    Checks whether the relaxation of a simulation is run once and shared (see relax_particles): this needs the
+    "shared" relaxation, the initial configuration cache (system_paths["init_cache_dir"]) and a seed.
+    """
+    return params.get("relaxation", "shared") == "shared" and bool(system_paths.get("init_cache_dir")) \
+        and params.get("seed") is not None
+
+
+def split_configuration(configuration):
+    """
+    Splits a configuration (text, variables replaced) at its stage markers into a relaxation configuration (setup and
+    relaxation stage, ending with a dump of the relaxed particles) and a production configuration (setup and production
+    stage, starting from the relaxed particles). Returns None if the configuration has no stage markers.
+    """
+    if relaxation_marker not in configuration or production_marker not in configuration:
+        return None
+    setup, stages = configuration.split(relaxation_marker, 1)
+    relaxation, production = stages.split(production_marker, 1)
+    # The relaxed particles are dumped by one more time step after the last relaxation run, before its integrator is
+    # disabled
+    relaxation_lines = relaxation.split("\n")
+    last_run = max([line_idx for line_idx, line in enumerate(relaxation_lines) if line.startswith("run")], default=-1)
+    relaxation_lines.insert(last_run + 1, f"dump {relaxed_dump_name} {{ type=full; start=0; freq=1; multi; id; tp; "
+                                          f"flag; radius; coordinate; velocity; director; header }}\nrun 1")
+    relaxation_configuration = setup + relaxation_marker + "\n".join(relaxation_lines)
+    return relaxation_configuration, setup + production_marker + production
+
+
+def relax_particles(params, relaxation_configuration, outfile, timeout=None, supervisor=None):
+    """
+    Provides the relaxed initial particles of a simulation as outfile. The relaxation stage (see split_configuration)
+    runs once per initial configuration (see init_particles) and relaxation configuration, i.e. geometry and
+    interactions, in the initial configuration cache. All simulations that only differ after the relaxation, e.g. in
+    v0 or Dr, start from the same relaxed particles.
+    Returns the exit code of the relaxation run (0 if reused), None if it did not dump all relaxed particles.
+    """
+    cache_dir = system_paths["init_cache_dir"]
+    init_key, _ = init_cache_key(params)
+    key = hashlib.sha1((init_key + relaxation_configuration).encode()).hexdigest()[:16]
+    relaxed_file = os.path.join(cache_dir, f"{key}.relaxed.txt")
+    with init_cache_key_lock(key):
+        if os.path.isfile(relaxed_file):
+            print_log(f"-- Reusing relaxed configuration {key}")
+        else:
+            relax_dir = os.path.join(cache_dir, f"{key}.relax")
+            os.makedirs(relax_dir, exist_ok=True)
+            # Dumps of an earlier, failed relaxation are removed
+            for file in os.listdir(relax_dir):
+                if file.startswith(f"{relaxed_dump_name}_") and file.endswith(".dat"):
+                    os.remove(os.path.join(relax_dir, file))
+            init_particles(params, os.path.join(relax_dir, "particles.txt"), supervisor=supervisor)
+            relax_configuration_dir = os.path.join(relax_dir, "configuration.conf")
+            with open(relax_configuration_dir, "w") as conf_file:
+                conf_file.write(relaxation_configuration)
+            print_log(f"Relaxing initial configuration {init_key} -> {key}...")
+            exit_code = execute_samos(configuration_dir=relax_configuration_dir, result_dir=relax_dir,
+                                      timeout=timeout, supervisor=supervisor)
+            if exit_code != 0:
+                return exit_code
+            relaxed_dats = [file for file in os.listdir(relax_dir) if
+                            file.startswith(f"{relaxed_dump_name}_") and file.endswith(".dat")]
+            if len(relaxed_dats) == 0:
+                print_log(f"!! Relaxation did not dump the relaxed particles, see {relax_dir}")
+                return None
+            relaxed_dat = os.path.join(relax_dir, max(relaxed_dats, key=lambda file: read_time_index(path=file)))
+            relaxed_particles = columns_to_particles(read_dat(relaxed_dat))
+            particle_count = len(load_particles(os.path.join(relax_dir, "particles.txt")))
+            if len(relaxed_particles) != particle_count:
+                print_log(f"!! Relaxation dumped {len(relaxed_particles)} instead of {particle_count} particles, "
+                          f"see {relaxed_dat}")
+                return None
+            header = f"# Relaxed initial configuration {init_key}\n# Generated on : {datetime.datetime.now()}\n"
+            relaxed_tmp = os.path.join(cache_dir, f"{key}.{os.getpid()}.tmp")
+            save_particles(particles=relaxed_particles, outfile=relaxed_tmp, header=header)
+            os.replace(relaxed_tmp, relaxed_file)
+    shutil.copy(relaxed_file, outfile)
+    return 0
+
+
+def run_simulation(params, group_folder, session, naming_conv, run_samos=True, timeout=None, supervisor=None):
     """
     For a dictionary of parameters (see run_samos.py), samos is executed within a folder named according to naming_conv
-    inside the folder session.
+    inside the folder session. Returns the SAMoS exit code (see execute_samos), None if SAMoS is not executed.
     """
     # Import user system paths from paths_init.py
-    samos_dir = system_paths["samos_dir"]
     if params["track"]:
         configuration_file = system_paths["conf_file_trackers"]
     elif params["tumoroid_ecm"]:
@@ -55,10 +488,11 @@ def run_simulation(params, group_folder, session, naming_conv, run_samos=True):
     new_particles_dir = os.path.join(result_dir, "particles.txt")
     try:
         # Copies configuration file to results folder.
-        os.system(f"cp {configuration_file} {new_configuration_dir}")
-        # Copies initialisation Python script to results folder.
-        os.system(f"cp {intialisation_file} {new_initialisation_dir}")
-    except:
+        shutil.copy(configuration_file, new_configuration_dir)
+        # Copies initialisation Python script to results folder, with the particle array module it imports.
+        shutil.copy(intialisation_file, new_initialisation_dir)
+        shutil.copy(os.path.join(os.path.dirname(intialisation_file), "particle_array.py"), result_dir)
+    except OSError:
         print_log("Could not copy file to result directory...")
 
     with open(new_configuration_dir, "r+") as conf_file:
@@ -67,211 +501,118 @@ def run_simulation(params, group_folder, session, naming_conv, run_samos=True):
         for varname in params.keys():
             configuration = re.sub("@" + varname, str(params[varname]), configuration)
 
+        # A shared relaxation needs the initial configuration cache and SAMoS, the run itself only does the production
+        stages = None
+        if run_samos and shares_relaxation(params):
+            stages = split_configuration(configuration)
+        if stages is not None:
+            configuration = stages[1]
+
         conf_file.seek(0)
         conf_file.write(configuration)
         conf_file.truncate()
-    # Executes Python script to initialise particles and save to the result folder
-    if params["plane"]:
-        collective = init_cells.Plane(L=params["L"], phi=params["phi"], cell_radius=params["cell_radius"],
-                                      poly=params["cell_radius_poly"])
-        init_cells.save_initial_cells(collective.cells, new_particles_dir)
-    elif params["tumoroid_ecm"]:
-        all_particles = init_tumoroid_ecm.Spheroid(cell_N=params["Ncell"], cell_radius=params["rcell"],
-                                                   cell_poly=params["polycell"],
-                                                   ecm_phi=params["phiecm"], ecm_radius=params["recm"],
-                                                   ecm_poly=params["polyecm"], ecm_size=params["L"]).cells
-        init_tumoroid_ecm.save_initial_cells(cells_data=all_particles, outfile=new_particles_dir)
+    # Initialises the particles (or reuses a cached initial configuration) and saves them to the result folder
+    if stages is None:
+        init_particles(params, new_particles_dir, supervisor=supervisor)
     else:
-        collective = init_cells.Spheroid(cell_radius=params["cell_radius"], cell_count=params["Ncell"],
-                                         poly=params["cell_radius_poly"], add_tracker_cells=params["track"],
-                                         tracker_cell_count=params["Ntrack"])
-        init_cells.save_initial_cells(collective.cells, new_particles_dir)
-
-    # Finally, moves to the result folder and executes SAMoS using the configuration file.
-    try:
-        os.chdir(result_dir)
-    except:
-        print_log("Could not move to result directory...")
+        exit_code = relax_particles(params, relaxation_configuration=stages[0], outfile=new_particles_dir,
+                                    timeout=timeout, supervisor=supervisor)
+        if exit_code != 0:
+            print_log(f"!! Relaxation failed, not running {result_dir}")
+            return exit_code
 
+    # Finally, executes SAMoS within the result folder using the configuration file.
+    exit_code = None
     if run_samos:
-        try:
-            print_log("Executing SAMoS...")
-            os.system(f"{samos_dir} {new_configuration_dir}")
-        except:
-            print_log("Could not locate SAMoS executable...")
+        print_log("Executing SAMoS...")
+        exit_code = execute_samos(configuration_dir=new_configuration_dir, result_dir=result_dir, timeout=timeout,
+                                  supervisor=supervisor)
+    # The initial configuration of a finished simulation can be archived compressed ("gzip") or packed ("npy")
+    archive_init = params.get("archive_init", "none")
+    if exit_code == 0 and archive_init in archive_extensions:
+        save_particles(particles=load_particles(new_particles_dir),
+                       outfile=new_particles_dir + archive_extensions[archive_init])
+        os.remove(new_particles_dir)
     print_log(f"Finished! Location of results: {result_dir}")
     visualise_result_tree(path=system_paths["output_samos_dir"], tree_type="output")
+    return exit_code
 
 
-def run_sweep(sweep_type, global_parameters, parameter_1D_sweep, parameter_2D_sweep, parameter_3D_sweep,
-              enable_samos_exec, group_folder, debug, digit_precision, num_cores):
+def run_sweep(sweep_axes, global_parameters, enable_samos_exec, group_folder, debug, digit_precision, num_cores,
+              timeout=None, sampling="grid", num_samples=None, sampling_seed=0, schedule="longest"):
     """
-    This multi-dimensional sweeping handler operates in 3 sweep_types: Single value, 1 parameter range and 2 parameter
-    ranges. In the first case, the global_parameters are used.
+    This multi-dimensional sweeping handler varies any number of parameters, given as sweep axes (see
+    scripts/sweep_planner.py) combined by the sampling (grid/zip/random/lhs). Without axes, a single simulation with
+    the global_parameters is run.
+    With schedule "longest", the simulations with the longest estimated runtime are started first, such that the
+    last simulations of a sweep are short ones and no cores idle while a long one finishes. The runtime is the
+    estimated cost (see estimate_cost) scaled by the measured seconds per cost of earlier simulations of the same
+    geometry in the group folder (see estimate_runtime), the cost alone if there are none yet. This needs all
+    parameter points to be planned up front (a list of their parameters, small next to the simulations). With schedule
+    "order" they are planned one by one and started in the order of the sweep.
+    Up to num_cores simulations run at the same time, each one is killed after timeout seconds (if given).
+    Simulations that are done according to the sweep ledger of the session are skipped, unless in debug mode.
     """
-    processes = []
-    pool = multiprocessing.Pool(processes=num_cores)
+    supervisor = SamosSupervisor(num_cores=num_cores, timeout=timeout, resume=not debug)
     folder_values = ["Nframes", "Ncell", "L", "phiecm", "kce", "divcell", "v0", "divasymprob"]
-    if sweep_type == 0:
+    if len(sweep_axes) == 0:
         print_log("!! Running single simulation without sweep")
-        params_dict = copy.deepcopy(global_parameters)
-        param_pair_label = create_samos_folder_name(folder_values=folder_values, global_parameters=params_dict)
-        if params_dict["track"]:
-            param_pair_label += "_track-{}".format(params_dict["Ntrack"])
-
-        session_label = param_pair_label
-        if debug:
-            session_label = "debug"
-            param_pair_label = "debug"
-        processes.append(pool.apply_async(func=run_simulation, args=(
-            params_dict, group_folder, session_label, param_pair_label, enable_samos_exec)))
-
-    if sweep_type == 1:
-        if parameter_1D_sweep["v1type"] == "custom":
-            v1range = parameter_1D_sweep["v1custom"]
-        else:
-            if parameter_1D_sweep["v1type"] == "log":
-                v1range = np.logspace(np.log10(parameter_1D_sweep["v1start"]),
-                                      np.log10(parameter_1D_sweep["v1end"]), parameter_1D_sweep["v1num"])
-            if parameter_1D_sweep["v1type"] == "linear":
-                v1range = np.linspace(parameter_1D_sweep["v1start"], parameter_1D_sweep["v1end"],
-                                      parameter_1D_sweep["v1num"])
-        v1range = np.round(v1range, digit_precision)
-
-        session_label = "{}_{}_{}-{}_#{}".format(parameter_1D_sweep["v1"], parameter_1D_sweep["v1type"],
-                                                 min(v1range), max(v1range), len(v1range))
-
-        print_log(f"!! Starting 1D parameter sweep for a total of {len(v1range)} parameter values...")
-        for var1_idx, var1 in enumerate(v1range):
-            progress = f"{round(100 * var1_idx / (len(v1range)))} %"
-            status = "{} {}".format(parameter_1D_sweep["v1"], var1)
-            progress_msg = f"[{progress}] Initialising --- {status} ---"
-            print_log(progress_msg)
+        session_label = None
+    else:
+        session_label = sweep_label(axes=sweep_axes, sampling=sampling, num_samples=num_samples,
+                                    digit_precision=digit_precision)
+        num_points = count_points(axes=sweep_axes, sampling=sampling, num_samples=num_samples)
+        print_log(f"!! Starting {len(sweep_axes)}D parameter sweep ({sampling}) for {num_points} parameter points...")
+
+    # Simulations to run, planned one by one: [estimated cost, parameters, session folder, run folder]
+    def plan_simulations():
+        for point in plan_points(axes=sweep_axes, sampling=sampling, num_samples=num_samples, seed=sampling_seed,
+                                 digit_precision=digit_precision):
             params_dict = copy.deepcopy(global_parameters)
-            params_dict[parameter_3D_sweep["v1"]] = var1
+            params_dict.update(point)
             param_pair_label = create_samos_folder_name(folder_values=folder_values, global_parameters=params_dict)
-            processes.append(pool.apply_async(func=run_simulation, args=(
-                params_dict, group_folder, session_label, param_pair_label, enable_samos_exec)))
+            run_session_label = session_label
+            if len(sweep_axes) == 0:
+                if params_dict["track"]:
+                    param_pair_label += "_track-{}".format(params_dict["Ntrack"])
+                run_session_label = param_pair_label
+                if debug:
+                    run_session_label = "debug"
+                    param_pair_label = "debug"
+            else:
+                # Varied parameters that are not part of the folder naming convention are added to the folder name
+                for name in point:
+                    if name not in folder_values:
+                        param_pair_label += f"_{name}-{params_dict[name]}"
+            yield [estimate_cost(params_dict), params_dict, run_session_label, param_pair_label]
 
-    if sweep_type == 2:
-        if parameter_2D_sweep["v1type"] == "custom":
-            v1range = parameter_2D_sweep["v1custom"]
-        else:
-            if parameter_2D_sweep["v1type"] == "log":
-                v1range = np.logspace(np.log10(parameter_2D_sweep["v1start"]),
-                                      np.log10(parameter_2D_sweep["v1end"]),
-                                      parameter_2D_sweep["v1num"])
-            if parameter_2D_sweep["v1type"] == "linear":
-                v1range = np.linspace(parameter_2D_sweep["v1start"], parameter_2D_sweep["v1end"],
-                                      parameter_2D_sweep["v1num"])
-        if parameter_2D_sweep["v2type"] == "custom":
-            v2range = parameter_2D_sweep["v2custom"]
-        else:
-            if parameter_2D_sweep["v2type"] == "log":
-                v2range = np.logspace(np.log10(parameter_2D_sweep["v2start"]),
-                                      np.log10(parameter_2D_sweep["v2end"]),
-                                      parameter_2D_sweep["v2num"])
-            if parameter_2D_sweep["v2type"] == "linear":
-                v2range = np.linspace(parameter_2D_sweep["v2start"], parameter_2D_sweep["v2end"],
-                                      parameter_2D_sweep["v2num"])
-        v1range = np.round(v1range, digit_precision)
-        v2range = np.round(v2range, digit_precision)
-
-        session_label = "{}_{}_{}-{}_#{}_vs_{}_{}_{}-{}_#{}".format(parameter_2D_sweep["v1"],
-                                                                    parameter_2D_sweep["v1type"],
-                                                                    min(v1range), max(v1range), len(v1range),
-                                                                    parameter_2D_sweep["v2"],
-                                                                    parameter_2D_sweep["v2type"],
-                                                                    min(v2range), max(v2range), len(v2range))
-
-        print_log(
-            f"!! Starting 2D parameter sweep for {len(v1range) * len(v2range)} parameter pairs...")
-        i_progress = 0
-        for var1_idx, var1 in enumerate(v1range):
-            for var2_idx, var2 in enumerate(v2range):
-                i_progress += 1
-                progress = f"{round(100 * i_progress / (len(v1range) * len(v2range)))} %"
-                status = "{} {} {} {}".format(parameter_2D_sweep["v1"], var1, parameter_2D_sweep["v2"], var2)
-                progress_msg = f"[{progress}] Initialising --- {status} ---"
-                print_log(progress_msg)
-                params_dict = copy.deepcopy(global_parameters)
-                params_dict[parameter_3D_sweep["v1"]] = var1
-                params_dict[parameter_3D_sweep["v2"]] = var2
-                param_pair_label = create_samos_folder_name(folder_values=folder_values, global_parameters=params_dict)
-                processes.append(pool.apply_async(func=run_simulation, args=(
-                    params_dict, group_folder, session_label, param_pair_label, enable_samos_exec)))
-
-    if sweep_type == 3:
-        if parameter_3D_sweep["v1type"] == "custom":
-            v1range = parameter_3D_sweep["v1custom"]
-        else:
-            if parameter_3D_sweep["v1type"] == "log":
-                v1range = np.logspace(np.log10(parameter_3D_sweep["v1start"]),
-                                      np.log10(parameter_3D_sweep["v1end"]),
-                                      parameter_3D_sweep["v1num"])
-            if parameter_3D_sweep["v1type"] == "linear":
-                v1range = np.linspace(parameter_3D_sweep["v1start"], parameter_3D_sweep["v1end"],
-                                      parameter_3D_sweep["v1num"])
-        if parameter_3D_sweep["v2type"] == "custom":
-            v2range = parameter_3D_sweep["v2custom"]
+    num_simulations = count_points(axes=sweep_axes, sampling=sampling, num_samples=num_samples)
+    simulations = plan_simulations()
+    if schedule == "longest":
+        # Estimated runtimes, from the runtimes of earlier simulations in this group folder
+        group_dir = os.path.join(system_paths["output_samos_dir"], group_folder)
+        runtime_per_cost = seconds_per_cost(group_dir)
+        if len(runtime_per_cost) == 0:
+            simulations = sorted(simulations, key=lambda simulation: simulation[0], reverse=True)
         else:
-            if parameter_3D_sweep["v2type"] == "log":
-                v2range = np.logspace(np.log10(parameter_3D_sweep["v2start"]),
-                                      np.log10(parameter_3D_sweep["v2end"]),
-                                      parameter_3D_sweep["v2num"])
-            if parameter_3D_sweep["v2type"] == "linear":
-                v2range = np.linspace(parameter_3D_sweep["v2start"], parameter_3D_sweep["v2end"],
-                                      parameter_3D_sweep["v2num"])
-        if parameter_3D_sweep["v3type"] == "custom":
-            v3range = parameter_3D_sweep["v3custom"]
-        else:
-            if parameter_3D_sweep["v3type"] == "log":
-                v3range = np.logspace(np.log10(parameter_3D_sweep["v3start"]),
-                                      np.log10(parameter_3D_sweep["v3end"]),
-                                      parameter_3D_sweep["v3num"])
-            if parameter_3D_sweep["v3type"] == "linear":
-                v3range = np.linspace(parameter_3D_sweep["v3start"], parameter_3D_sweep["v3end"],
-                                      parameter_3D_sweep["v3num"])
-
-        v1range = np.round(v1range, digit_precision)
-        v2range = np.round(v2range, digit_precision)
-        v3range = np.round(v3range, digit_precision)
-        session_label = "{}_{}_{}-{}_#{}_vs_{}_{}_{}-{}_#{}_vs_{}_{}_{}-{}_#{}".format(parameter_3D_sweep["v1"],
-                                                                                       parameter_3D_sweep["v1type"],
-                                                                                       min(v1range), max(v1range),
-                                                                                       len(v1range),
-                                                                                       parameter_3D_sweep["v2"],
-                                                                                       parameter_3D_sweep["v2type"],
-                                                                                       min(v2range), max(v2range),
-                                                                                       len(v2range),
-                                                                                       parameter_3D_sweep["v3"],
-                                                                                       parameter_3D_sweep["v3type"],
-                                                                                       min(v3range), max(v3range),
-                                                                                       len(v3range))
-
-        print_log(
-            f"!! Starting 3D parameter sweep for {len(v1range) * len(v2range) * len(v3range)} parameter pairs...")
-        i_progress = 0
-        for var1_idx, var1 in enumerate(v1range):
-            for var2_idx, var2 in enumerate(v2range):
-                for var3_idx, var3 in enumerate(v3range):
-                    i_progress += 1
-                    progress = f"{round(100 * i_progress / (len(v1range) * len(v2range) * len(v3range)))} %"
-                    status = "{} {} {} {} {} {}".format(parameter_3D_sweep["v1"], var1, parameter_3D_sweep["v2"], var2,
-                                                        parameter_3D_sweep["v3"], var3)
-                    progress_msg = f"[{progress}] Initialising --- {status} ---"
-                    print_log(progress_msg)
-                    params_dict = copy.deepcopy(global_parameters)
-                    params_dict[parameter_3D_sweep["v1"]] = var1
-                    params_dict[parameter_3D_sweep["v2"]] = var2
-                    params_dict[parameter_3D_sweep["v3"]] = var3
-                    param_pair_label = create_samos_folder_name(folder_values=folder_values,
-                                                                global_parameters=params_dict)
-                    processes.append(pool.apply_async(func=run_simulation, args=(
-                        params_dict, group_folder, session_label, param_pair_label, enable_samos_exec)))
-
-    for p in processes:
-        p.get()
-
-    pool.close()
-    pool.join()
+            # Simulations to run with their estimated runtime: [runtime, simulation]
+            runtimes = sorted(([estimate_runtime(simulation[1], simulation[0], runtime_per_cost), simulation] for
+                               simulation in simulations), key=lambda runtime: runtime[0], reverse=True)
+            simulations = [simulation for runtime, simulation in runtimes]
+            if len(simulations) > 0:
+                total_hours = sum(runtime for runtime, simulation in runtimes) / 3600
+                print_log(f"-- Estimated duration: {total_hours / min(num_cores, len(simulations)):.1f} h on "
+                          f"{num_cores} cores")
+
+    try:
+        for simulation_idx, (cost, params_dict, session_label, param_pair_label) in enumerate(simulations):
+            if len(sweep_axes) > 0:
+                progress = f"{round(100 * (simulation_idx + 1) / num_simulations)} %"
+                status = " ".join(f"{axis['name']} {params_dict[axis['name']]}" for axis in sweep_axes)
+                print_log(f"[{progress}] Initialising --- {status} ---")
+            supervisor.submit(params=params_dict, group_folder=group_folder, session=session_label,
+                              naming_conv=param_pair_label, run_samos=enable_samos_exec, cost=cost)
+        supervisor.wait()
+    except KeyboardInterrupt:
+        supervisor.cancel()
+        raise
@@ -0,0 +1,141 @@
+"""
+Collection of independent functions that plan multi-dimensional SAMoS parameter sweeps.
+!! This cannot be run independently, it is a helper script.
+Author: Konstantinos Andreadis
+*****************************************************************************
+*
+*  A sweep consists of any number of axes, each a dict:
+*     {"name": "v0", "type": "linear"/"log"/"custom", "start": .., "end": .., "num": .., "values": [..]}
+*  and a sampling scheme that combines the axes into parameter points:
+*     grid     all combinations of the axis values (nested loops)
+*     zip      the i-th values of all axes together (axes of equal length)
+*     random   num_samples points drawn uniformly within the axis ranges
+*     lhs      num_samples points of a Latin hypercube within the axis ranges
+*  Parameter points are generated one by one as dict {name: value}.
+*
+*****************************************************************************
+"""
+import itertools
+import numpy as np
+
+sampling_types = ["grid", "zip", "random", "lhs"]
+
+
+def make_axis(name, range_type="linear", start=None, end=None, num=None, values=None):
+    """
+    Creates a sweep axis for a parameter name, either a linear/log range from start to end with num points or a
+    list of custom values.
+    """
+    if values is not None and len(values) > 0:
+        range_type = "custom"
+    if range_type not in ["linear", "log", "custom"]:
+        raise ValueError(f"Unknown range type {range_type} of sweep parameter {name}")
+    return {"name": name, "type": range_type, "start": start, "end": end, "num": num,
+            "values": list(values) if values is not None else []}
+
+
+def parse_axis(text):
+    """
+    Creates a sweep axis from a command line string "name:type:start:end:num", e.g. "v0:log:0.01:1:5", or
+    "name:custom:value,value,..." (or just "name:value,value,...") for custom values.
+    """
+    parts = text.split(":")
+    if len(parts) == 2:
+        parts = [parts[0], "custom", parts[1]]
+    if len(parts) == 3 and parts[1] == "custom":
+        return make_axis(name=parts[0], values=[float(value) for value in parts[2].split(",")])
+    if len(parts) != 5:
+        raise ValueError(f"Sweep parameter {text} should be given as name:type:start:end:num or name:custom:values")
+    return make_axis(name=parts[0], range_type=parts[1], start=float(parts[2]), end=float(parts[3]),
+                     num=int(parts[4]))
+
+
+def axis_values(axis, digit_precision=5):
+    """
+    All values along a sweep axis, rounded to digit_precision.
+    """
+    if axis["type"] == "custom":
+        values = np.asarray(axis["values"], dtype=float)
+    elif axis["type"] == "log":
+        values = np.logspace(np.log10(axis["start"]), np.log10(axis["end"]), axis["num"])
+    else:
+        values = np.linspace(axis["start"], axis["end"], axis["num"])
+    return np.round(values, digit_precision)
+
+
+def axis_bounds(axis, digit_precision=5):
+    """
+    Range [low, high] of a sweep axis, used by the random and Latin hypercube sampling.
+    """
+    values = axis_values(axis, digit_precision)
+    return np.min(values), np.max(values)
+
+
+def count_points(axes, sampling="grid", num_samples=None):
+    """
+    Number of parameter points of a sweep.
+    """
+    if len(axes) == 0:
+        return 1
+    if sampling == "grid":
+        return int(np.prod([len(axis_values(axis)) for axis in axes]))
+    if sampling == "zip":
+        return min(len(axis_values(axis)) for axis in axes)
+    return num_samples
+
+
+def sample_axis(axis, u, digit_precision=5):
+    """
+    Maps uniform numbers u in [0, 1) onto a sweep axis: linear or logarithmic within its range, or one of its custom
+    values.
+    """
+    if axis["type"] == "custom":
+        values = axis_values(axis, digit_precision)
+        return values[np.minimum((u * len(values)).astype(int), len(values) - 1)]
+    low, high = axis_bounds(axis, digit_precision)
+    if axis["type"] == "log":
+        return np.round(10 ** (np.log10(low) + u * (np.log10(high) - np.log10(low))), digit_precision)
+    return np.round(low + u * (high - low), digit_precision)
+
+
+def plan_points(axes, sampling="grid", num_samples=None, seed=0, digit_precision=5):
+    """
+    Generator of all parameter points {name: value} of a sweep over the axes, see the sampling types above.
+    The random and Latin hypercube sampling use a fixed seed, so that an interrupted sweep plans the same points again.
+    """
+    if sampling not in sampling_types:
+        raise ValueError(f"Unknown sampling {sampling}, choose from {sampling_types}")
+    names = [axis["name"] for axis in axes]
+    if sampling in ["grid", "zip"]:
+        values = [axis_values(axis, digit_precision).tolist() for axis in axes]
+        if sampling == "zip" and len(set(len(axis_vals) for axis_vals in values)) > 1:
+            raise ValueError("All sweep parameters should have the same number of values for zip sampling")
+        combinations = itertools.product(*values) if sampling == "grid" else zip(*values)
+        for point in combinations:
+            yield dict(zip(names, point))
+        return
+
+    rng = np.random.default_rng(seed)
+    if sampling == "random":
+        u = rng.random((num_samples, len(axes)))
+    else:
+        # Latin hypercube: each axis is divided into num_samples strata, each stratum is sampled exactly once
+        strata = np.array([rng.permutation(num_samples) for _ in axes]).T.reshape(num_samples, len(axes))
+        u = (strata + rng.random((num_samples, len(axes)))) / num_samples
+    samples = [sample_axis(axis, u[:, axis_idx], digit_precision) for axis_idx, axis in enumerate(axes)]
+    for sample_idx in range(num_samples):
+        yield {name: samples[axis_idx][sample_idx].item() for axis_idx, name in enumerate(names)}
+
+
+def sweep_label(axes, sampling="grid", num_samples=None, digit_precision=5):
+    """
+    Session folder name of a sweep, e.g. "v0_linear_0.01-0.1_#5_vs_kce_log_0.1-1.0_#3".
+    """
+    labels = []
+    for axis in axes:
+        values = axis_values(axis, digit_precision)
+        labels.append(f"{axis['name']}_{axis['type']}_{min(values)}-{max(values)}_#{len(values)}")
+    label = "_vs_".join(labels)
+    if sampling != "grid":
+        label += f"_{sampling}_#{count_points(axes, sampling, num_samples)}"
+    return label
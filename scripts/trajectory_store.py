@@ -0,0 +1,259 @@
+"""
+Binary trajectory store of a SAMoS output folder, built once from its .dat files and opened with np.memmap.
+!! This cannot be run independently, it is a helper script.
+Author: Konstantinos Andreadis
+*****************************************************************************
+*
+*  Layout of <run folder>/.trajectory:
+*     manifest.json   source .dat files (name, mtime, size), frame count and column dtypes/shapes
+*     time.bin        SAMoS time step of each frame (Nframes)
+*     offsets.bin     first row of each frame, frame k spans rows offsets[k]:offsets[k+1] (Nframes + 1)
+*     id.bin, type.bin, radius.bin                       (Nrows)
+*     position.bin, velocity.bin, director.bin           (Nrows x 3)
+*  Frames are concatenated, so a varying particle count (cell division) is supported.
+*
+*****************************************************************************
+"""
+import os
+import json
+import shutil
+import numpy as np
+
+from scripts.data_handler import read_dat, read_time_index, stream_frames
+from scripts.communication_handler import print_log
+
+store_folder_name = ".trajectory"
+store_version = 1
+# Stored columns: name -> (dtype, .dat columns)
+store_columns = {
+    "id": ("int64", ["id"]),
+    "type": ("int64", ["type"]),
+    "radius": ("float64", ["radius"]),
+    "position": ("float64", ["x", "y", "z"]),
+    "velocity": ("float64", ["vx", "vy", "vz"]),
+    "director": ("float64", ["nx", "ny", "nz"]),
+}
+
+
+def list_dat_files(folder_path):
+    """
+    Sorted list of .dat files inside a SAMoS output folder.
+    """
+    return [f for f in sorted(os.listdir(folder_path)) if f.endswith(".dat")]
+
+
+def dat_files_status(folder_path, dat_files):
+    """
+    List of [name, mtime (ns), size] of the .dat files, used to detect changed source files.
+    """
+    status = []
+    for dat_dir in dat_files:
+        stat = os.stat(os.path.join(folder_path, dat_dir))
+        status.append([dat_dir, stat.st_mtime_ns, stat.st_size])
+    return status
+
+
+def read_manifest(store_dir):
+    """
+    Read the manifest of a trajectory store, None if not available.
+    """
+    try:
+        with open(os.path.join(store_dir, "manifest.json"), "r") as jsonfile:
+            return json.load(jsonfile)
+    except (OSError, ValueError):
+        return None
+
+
+def is_store_valid(folder_path, dat_files=None):
+    """
+    Checks whether the trajectory store of a folder exists and matches the current .dat files.
+    """
+    if dat_files is None:
+        dat_files = list_dat_files(folder_path)
+    manifest = read_manifest(os.path.join(folder_path, store_folder_name))
+    if manifest is None or manifest.get("version") != store_version:
+        return False
+    return manifest["files"] == dat_files_status(folder_path, dat_files)
+
+
+def build_trajectory_store(folder_path, dat_files=None):
+    """
+    Converts all .dat files of a SAMoS output folder into the binary trajectory store. Frames are parsed one by one and
+    appended to the column files, so memory use does not grow with the number of frames.
+    """
+    if dat_files is None:
+        dat_files = list_dat_files(folder_path)
+    store_dir = os.path.join(folder_path, store_folder_name)
+    build_dir = f"{store_dir}.build-{os.getpid()}"
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+    status = dat_files_status(folder_path, dat_files)
+
+    column_files = {name: open(os.path.join(build_dir, f"{name}.bin"), "wb") for name in store_columns}
+    time = []
+    offsets = [0]
+    try:
+        for dat_dir in dat_files:
+            data = read_dat(path=os.path.join(folder_path, dat_dir))
+            for name, (dtype, dat_columns) in store_columns.items():
+                column = np.column_stack([data[col] for col in dat_columns]) if len(dat_columns) > 1 else data[
+                    dat_columns[0]]
+                np.ascontiguousarray(column, dtype=dtype).tofile(column_files[name])
+            time.append(read_time_index(path=dat_dir))
+            offsets.append(offsets[-1] + len(data["id"]))
+    finally:
+        for column_file in column_files.values():
+            column_file.close()
+    np.asarray(time, dtype="int64").tofile(os.path.join(build_dir, "time.bin"))
+    np.asarray(offsets, dtype="int64").tofile(os.path.join(build_dir, "offsets.bin"))
+
+    manifest = {
+        "version": store_version,
+        "files": status,
+        "frames": len(time),
+        "rows": offsets[-1],
+        "columns": {name: {"dtype": dtype, "width": len(dat_columns)} for name, (dtype, dat_columns) in
+                    store_columns.items()},
+    }
+    with open(os.path.join(build_dir, "manifest.json"), "w") as jsonfile:
+        json.dump(manifest, jsonfile, indent=4)
+
+    shutil.rmtree(store_dir, ignore_errors=True)
+    try:
+        os.replace(build_dir, store_dir)
+    except OSError:
+        # Another process finished building the same store first
+        shutil.rmtree(build_dir, ignore_errors=True)
+        if not is_store_valid(folder_path, dat_files):
+            raise
+    print_log(f"-- Stored {len(time)} frames of {os.path.basename(folder_path)} as binary trajectory")
+    return store_dir
+
+
+def extend_trajectory_store(folder_path, dat_files=None):
+    """
+    Appends the frames of .dat files that were added since the trajectory store was built (e.g. a simulation that is
+    still running), as long as the previously stored files are unchanged. Returns False if a full rebuild is needed.
+    """
+    if dat_files is None:
+        dat_files = list_dat_files(folder_path)
+    store_dir = os.path.join(folder_path, store_folder_name)
+    manifest = read_manifest(store_dir)
+    status = dat_files_status(folder_path, dat_files)
+    if manifest is None or manifest.get("version") != store_version:
+        return False
+    if manifest["files"] != status[:len(manifest["files"])]:
+        return False
+    new_files = dat_files[len(manifest["files"]):]
+
+    time = np.fromfile(os.path.join(store_dir, "time.bin"), dtype="int64", count=manifest["frames"]).tolist()
+    offsets = np.fromfile(os.path.join(store_dir, "offsets.bin"), dtype="int64",
+                          count=manifest["frames"] + 1).tolist()
+    column_files = {}
+    try:
+        for name, (dtype, dat_columns) in store_columns.items():
+            # Drop rows of an interrupted earlier extension, beyond what the manifest describes
+            column_files[name] = open(os.path.join(store_dir, f"{name}.bin"), "r+b")
+            column_files[name].truncate(manifest["rows"] * len(dat_columns) * np.dtype(dtype).itemsize)
+            column_files[name].seek(0, os.SEEK_END)
+        for dat_dir in new_files:
+            data = read_dat(path=os.path.join(folder_path, dat_dir))
+            for name, (dtype, dat_columns) in store_columns.items():
+                column = np.column_stack([data[col] for col in dat_columns]) if len(dat_columns) > 1 else data[
+                    dat_columns[0]]
+                np.ascontiguousarray(column, dtype=dtype).tofile(column_files[name])
+            time.append(read_time_index(path=dat_dir))
+            offsets.append(offsets[-1] + len(data["id"]))
+    finally:
+        for column_file in column_files.values():
+            column_file.close()
+    # The index files are written aside and replaced at once (readers keep their memory map of the old ones), the
+    # manifest is replaced last, so an interrupted extension leaves a valid (shorter) store behind
+    for name, values in [["time", time], ["offsets", offsets]]:
+        index_tmp = os.path.join(store_dir, f"{name}.bin.{os.getpid()}")
+        np.asarray(values, dtype="int64").tofile(index_tmp)
+        os.replace(index_tmp, os.path.join(store_dir, f"{name}.bin"))
+    manifest.update({"files": status, "frames": len(time), "rows": offsets[-1]})
+    manifest_tmp = os.path.join(store_dir, f"manifest.json.{os.getpid()}")
+    with open(manifest_tmp, "w") as jsonfile:
+        json.dump(manifest, jsonfile, indent=4)
+    os.replace(manifest_tmp, os.path.join(store_dir, "manifest.json"))
+    print_log(f"-- Appended {len(new_files)} frames to binary trajectory of {os.path.basename(folder_path)}")
+    return True
+
+
+def open_trajectory_store(folder_path, dat_files=None):
+    """
+    Opens the trajectory store of a SAMoS output folder as read-only memory maps, extending or (re)building it first if
+    it is missing or older than the .dat files. Returns a dict with "time", "offsets", "files" and all stored columns.
+    A store whose files do not match its manifest (e.g. cut short by an interruption) is rebuilt once, a ValueError is
+    raised if it is still damaged.
+    """
+    if dat_files is None:
+        dat_files = list_dat_files(folder_path)
+    store_dir = os.path.join(folder_path, store_folder_name)
+    if not is_store_valid(folder_path, dat_files) and not extend_trajectory_store(folder_path, dat_files):
+        build_trajectory_store(folder_path, dat_files)
+    try:
+        return map_trajectory_store(store_dir)
+    except ValueError:
+        print_log(f"-- Binary trajectory of {os.path.basename(folder_path)} is damaged, rebuilding...")
+        build_trajectory_store(folder_path, dat_files)
+        return map_trajectory_store(store_dir)
+
+
+def map_trajectory_store(store_dir):
+    """
+    Memory maps all files of a trajectory store (see open_trajectory_store), ValueError if a file is too short.
+    """
+    manifest = read_manifest(store_dir)
+
+    def memmap(name, dtype, shape):
+        if np.prod(shape) == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(os.path.join(store_dir, f"{name}.bin"), dtype=dtype, mode="r", shape=shape)
+
+    store = {
+        "files": [status[0] for status in manifest["files"]],
+        "time": memmap("time", "int64", (manifest["frames"],)),
+        "offsets": memmap("offsets", "int64", (manifest["frames"] + 1,)),
+    }
+    for name, column in manifest["columns"].items():
+        shape = (manifest["rows"], column["width"]) if column["width"] > 1 else (manifest["rows"],)
+        store[name] = memmap(name, column["dtype"], shape)
+    return store
+
+
+def read_store_frame(store, frame_idx):
+    """
+    Frame frame_idx of a trajectory store as a dict of column arrays, in the same form as data_handler.read_dat.
+    """
+    start, end = store["offsets"][frame_idx], store["offsets"][frame_idx + 1]
+    data = {}
+    for name, (dtype, dat_columns) in store_columns.items():
+        if len(dat_columns) > 1:
+            for col_idx, col in enumerate(dat_columns):
+                data[col] = store[name][start:end, col_idx]
+        else:
+            data[dat_columns[0]] = store[name][start:end]
+    data["type index"] = {int(group_index): np.flatnonzero(data["type"] == group_index) for group_index in
+                          np.unique(data["type"])}
+    return data
+
+
+def stream_trajectory(folder_path, dat_files=None, max_iter=None):
+    """
+    Generator yielding (file name, time step, data) for each frame of a SAMoS output folder from its trajectory store.
+    Falls back to parsing the .dat files if the store cannot be written (e.g. read-only output folder).
+    """
+    if dat_files is None:
+        dat_files = list_dat_files(folder_path)
+    try:
+        store = open_trajectory_store(folder_path, dat_files)
+    except (OSError, ValueError):
+        print_log(f"-- Could not store binary trajectory of {os.path.basename(folder_path)}, reading .dat files...")
+        yield from stream_frames(folder_path=folder_path, dat_files=dat_files, max_iter=max_iter)
+        return
+    for frame_idx, dat_dir in enumerate(store["files"]):
+        yield dat_dir, int(store["time"][frame_idx]), read_store_frame(store, frame_idx)
+        if frame_idx == max_iter: break
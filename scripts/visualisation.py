@@ -12,9 +12,12 @@ from paths_init import system_paths
 from scripts.communication_handler import print_log
 import textwrap
 import numpy as np
+from multiprocessing import Pool
 
 # If no dpi is specified by the user when running the visualisation scripts, this resolution variable overwrites.
 png_res_dpi = 300
+# All plots are drawn on one reused figure, see new_figure
+reused_figure_label = "visualisation"
 
 
 def create_png_path(session_label, plot_label, type_plot=None):
@@ -36,26 +39,70 @@ def create_png_path(session_label, plot_label, type_plot=None):
     return full_path
 
 
-def plot_handler(session, dpi, label, show, type_plot=None):
+def set_plot_style():
     """
-    Resizes font, changes layout and saves figure. If show is True, it also displays the plot.
+    Sets the font sizes of all plots, once per process before any figure is drawn.
     """
     plt.rc('font', size=10)  # legend fontsize
     plt.rc('axes', labelsize=14)  # fontsize of the x and y labels
     plt.rc('figure', titlesize=14)  # fontsize of the figure title
+
+
+def new_figure(figsize=None):
+    """
+    Clears the figure that is reused by all plots and resizes it (default size if figsize is None).
+    """
+    fig = plt.figure(num=reused_figure_label, clear=True)
+    fig.set_size_inches(figsize if figsize is not None else plt.rcParams["figure.figsize"])
+    return fig
+
+
+def plot_handler(session, dpi, label, show, type_plot=None):
+    """
+    Changes layout and saves figure. If show is True, it also displays the plot.
+    """
     plt.tight_layout()
     plt.savefig(create_png_path(session, label, type_plot), dpi=dpi, bbox_inches="tight")
     if show:
         plt.show()
-    else:
-        plt.close()
+
+
+def run_plot_job(job):
+    """
+    Executes a plot job [plot function, keyword arguments], e.g. [plot_msd, {"session": ..., "data": ...}].
+    """
+    plot_function, kwargs = job
+    plot_function(**kwargs)
+
+
+def init_plot_worker():
+    """
+    Initialises a plotting worker process once: non-interactive backend and plot style.
+    """
+    plt.switch_backend("Agg")
+    set_plot_style()
+
+
+def run_plot_jobs(jobs, num_cores=1, show=False):
+    """
+    Executes a list of plot jobs (see run_plot_job) on num_cores worker processes, in this process if shown.
+    """
+    if show or num_cores <= 1 or len(jobs) <= 1:
+        set_plot_style()
+        for job in jobs:
+            run_plot_job(job)
+        return
+    print_log(f"-- Plotting {len(jobs)} figures on {num_cores} cores...")
+    with Pool(processes=min(num_cores, len(jobs)), initializer=init_plot_worker) as pool:
+        for _ in pool.imap_unordered(run_plot_job, jobs, chunksize=max(1, len(jobs) // (4 * num_cores))):
+            pass
 
 
 def plot_boxplot(session, data, x, y, hue, show=True, dpi=png_res_dpi):
     """
     Boxplot visualisation
     """
-    plt.figure()
+    new_figure()
     plt.title(f"{y} vs. {x} \n {session}")
     sns.boxplot(data, x=x, y=y, hue=hue)
     plot_handler(session, dpi, f"box_{y}_vs_{x}", show)
@@ -65,7 +112,7 @@ def plot_scatterplot(session, data, x, y, hue, style, show=True, dpi=png_res_dpi
     """
     Scatterplot visualisation
     """
-    plt.figure()
+    new_figure()
     plt.title(f"{y} vs. {x} \n {session}")
     sns.scatterplot(data, x=x, y=y, hue=hue, style=style)
     plot_handler(session, dpi, f"scatter_{hue}_for_{y}_vs_{x}", show)
@@ -77,7 +124,7 @@ def plot_msd(session, data, x, y, hue, show=True, dpi=png_res_dpi,
     """
     MSD visualisation
     """
-    plt.figure(figsize=(10, 6))
+    new_figure(figsize=(10, 6))
     title = f"{y} vs. {x} {extra_label}"
     plt.title(textwrap.shorten(title, width=50))
 
@@ -128,7 +175,7 @@ def plot_lineplot(session, data, x, y, hue=None, style=None, show=True, dpi=png_
     """
     Line plot visualisation
     """
-    plt.figure(figsize=(7, 5))
+    new_figure(figsize=(7, 5))
     title = f"{y} vs. {x} {extra_label}"
     plt.title(textwrap.shorten(title, width=50))
     if type(y) == list:
@@ -163,11 +210,10 @@ def plot_profile(varlabels, session, data, x, y, hue=None, show=True, dpi=png_re
     """
     Profile plot visualisation
     """
-    plt.figure(figsize=(6, 5))
+    new_figure(figsize=(6, 5))
     title = f"{y} vs. {x} [c={hue}] \n {extra_label} \n {session[:len(session) // 2]}..."
     plt.title(title)
-    for hueval in np.unique(data[hue].values):
-        data_time = data.groupby(hue).get_group(hueval)
+    for hueval, data_time in data.groupby(hue):
         color_float = hueval / max(data[hue].values)
         plt.plot(data_time[x].values[0], data_time[y].values[0], label=hueval, c=cm.rainbow(color_float), marker="o",
                  markersize=2, alpha=0.8)
@@ -184,7 +230,7 @@ def plot_heatmap(session, data, rows, columns, values, show=True, cmap="coolwarm
     """
     Heatmap visualisation
     """
-    plt.figure(figsize=(10, 10))
+    new_figure(figsize=(10, 10))
     plt.title(f"{values} for {rows} vs. {columns} \n {session}")
     pivot_result = data.pivot(index=rows, columns=columns, values=values)
     ax = sns.heatmap(pivot_result, linewidth=1, cmap=cmap)  # annot = True
@@ -198,7 +244,7 @@ def plot_phase_diagram(session, data, rows, columns, values, show=True, cmap="co
     """
     title = f"{values} for {rows} vs. {columns} \n {session}"
     avg_data = data.groupby([rows, columns])[values].mean().unstack()
-    plt.figure(figsize=(5, 5))
+    new_figure(figsize=(5, 5))
     plt.title(title)
     ax = sns.heatmap(avg_data, linewidth=1, cmap=cmap)
     ax.invert_yaxis()
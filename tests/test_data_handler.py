@@ -0,0 +1,57 @@
+"""
+Tests of the .dat dump parser (scripts/data_handler.read_dat) for the dump layouts written by the configurations.
+"""
+import numpy as np
+import pytest
+
+from scripts.data_handler import read_dat, samos_dat_columns
+
+
+def write_dat(tmp_path, content):
+    path = tmp_path / "output_0000001000.dat"
+    path.write_text(content)
+    return str(path)
+
+
+def test_read_dat_header(tmp_path):
+    path = write_dat(tmp_path, "# id type flag radius x y z vx vy vz nx ny nz\n"
+                               "1 1 0 1.0 0.5 -0.5 2.0 0 0 0 1 0 0\n"
+                               "2 2 0 0.8 1.5 1.5 -2.0 0.1 0 0 0 1 0\n")
+    data = read_dat(path)
+    assert data["id"].dtype == np.int64
+    np.testing.assert_allclose(data["x"], [0.5, 1.5])
+    np.testing.assert_allclose(data["vx"], [0.0, 0.1])
+    assert data["x"].flags["C_CONTIGUOUS"]
+    np.testing.assert_array_equal(data["type index"][2], [1])
+
+
+def test_read_dat_keys(tmp_path):
+    # Plane dumps (dump with "keys", see samos_init/plane.conf) name their own columns after "keys:"
+    path = write_dat(tmp_path, "keys: id type radius x y z vx vy vz nx ny nz nvx nvy nvz area boundary\n"
+                               "1 1 1.0 0.5 -0.5 0 0 0 0 1 0 0 0 0 1 3.1 0\n"
+                               "2 1 1.2 1.5 1.5 0 0 0 0 0 1 0 0 0 1 4.5 1\n")
+    data = read_dat(path)
+    np.testing.assert_allclose(data["radius"], [1.0, 1.2])
+    np.testing.assert_allclose(data["area"], [3.1, 4.5])
+    np.testing.assert_array_equal(data["type index"][1], [0, 1])
+    assert "flag" not in data
+
+
+def test_read_dat_without_header(tmp_path):
+    path = write_dat(tmp_path, "1 1 0 1.0 0.5 -0.5 2.0 0 0 0 1 0 0\n")
+    data = read_dat(path)
+    assert all(column in data for column in samos_dat_columns)
+    np.testing.assert_allclose(data["z"], [2.0])
+
+
+def test_read_dat_column_mismatch(tmp_path):
+    path = write_dat(tmp_path, "1 1 1.0 0.5 -0.5 2.0 0 0 0 1 0 0\n")
+    with pytest.raises(ValueError):
+        read_dat(path)
+
+
+def test_read_dat_empty(tmp_path):
+    path = write_dat(tmp_path, "# id type flag radius x y z vx vy vz nx ny nz\n")
+    data = read_dat(path)
+    assert len(data["id"]) == 0
+    assert data["type index"] == {}